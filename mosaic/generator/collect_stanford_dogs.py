@@ -1,10 +1,127 @@
+import argparse
 import os
 import shutil
 import random
+from multiprocessing import Pool
 from pathlib import Path
 
-def collect_dog_images(stanford_path, output_dir, images_per_breed=2, total_images=200):
-    """Collect diverse high-quality dog images from Stanford Dogs dataset"""
+import numpy as np
+from PIL import Image
+
+
+def image_features(image_file):
+    """Return (mean RGB, 64-bit difference hash) of an image, or None if it can't be read.
+
+    Both come from one small decode: JPEGs are decoded in draft mode, center-cropped and
+    thumbnailed, and the hash compares neighbouring pixels of a 9x8 grayscale version.
+    """
+    try:
+        with Image.open(image_file) as image:
+            image.draft('RGB', (64, 64))
+            image = image.convert('RGB')
+            width, height = image.size
+            side = min(width, height)
+            image = image.crop(((width - side) // 2, (height - side) // 2,
+                                (width - side) // 2 + side, (height - side) // 2 + side))
+            image.thumbnail((64, 64))
+            mean = np.asarray(image, dtype=np.float64).mean(axis=(0, 1))
+            gray = np.asarray(image.convert('L').resize((9, 8), Image.Resampling.LANCZOS), dtype=np.int16)
+            bits = (gray[:, 1:] > gray[:, :-1]).ravel()
+            return mean, int(np.packbits(bits).view('>u8')[0])
+    except Exception:
+        return None
+
+
+def hamming_distances(hashes, value):
+    """Return the number of differing bits between every uint64 in hashes and value"""
+    differences = np.bitwise_xor(hashes, np.uint64(value))
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(differences)
+    return np.unpackbits(differences.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def select_by_coverage(means, hashes, budget, duplicate_distance=6):
+    """Pick up to budget candidates that spread as evenly as possible over RGB space.
+
+    Farthest-point (greedy k-center) selection: start from the candidate farthest from the
+    average colour, then repeatedly add the candidate farthest from everything picked so far.
+    A candidate whose perceptual hash is within duplicate_distance bits of one already picked
+    is a near-duplicate and is dropped instead.
+
+    Returns the indices of the picked candidates, in the order they were picked.
+    """
+    means = np.asarray(means, dtype=np.float64)
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    distances = np.linalg.norm(means - means.mean(axis=0), axis=1)
+    available = np.ones(len(means), dtype=bool)
+    selected = []
+    while len(selected) < budget and available.any():
+        candidate = int(np.argmax(np.where(available, distances, -1)))
+        available[candidate] = False
+        if selected and hamming_distances(hashes[selected], hashes[candidate]).min() <= duplicate_distance:
+            continue
+        if not selected:
+            distances = np.full(len(means), np.inf)
+        selected.append(candidate)
+        distances = np.minimum(distances, np.linalg.norm(means - means[candidate], axis=1))
+    return selected
+
+
+def collect_by_coverage(breed_dirs, output_path, total_images, duplicate_distance=6, workers=None):
+    """Copy the total_images candidates from breed_dirs that best cover colour space"""
+    candidates = []
+    for breed_count, breed_dir in enumerate(breed_dirs):
+        breed_name = breed_dir.name.split('-')[1] if '-' in breed_dir.name else breed_dir.name
+        for ext in ['*.jpg', '*.jpeg', '*.png']:
+            candidates.extend((breed_count, breed_name, image_file) for image_file in sorted(breed_dir.glob(ext)))
+    print(f"Computing colour features of {len(candidates)} candidate images...")
+    
+    # Decode every candidate once, in parallel, skipping the unreadable ones
+    with Pool(workers) as pool:
+        features = pool.map(image_features, [image_file for _, _, image_file in candidates],
+                            chunksize=max(1, min(64, len(candidates) // 64)))
+    readable = [i for i, feature in enumerate(features) if feature is not None]
+    if len(readable) < len(candidates):
+        print(f"  Skipped {len(candidates) - len(readable)} unreadable images")
+    candidates = [candidates[i] for i in readable]
+    if not candidates:
+        return 0
+    means = np.array([features[i][0] for i in readable])
+    hashes = np.array([features[i][1] for i in readable], dtype=np.uint64)
+    
+    selected = select_by_coverage(means, hashes, total_images, duplicate_distance)
+    
+    # Report how well the picks cover the colour space of all candidates
+    picked = means[selected]
+    covering = np.sqrt(max(((means[i:i + 4096, None] - picked) ** 2).sum(axis=2).min(axis=1).max()
+                           for i in range(0, len(means), 4096)))
+    print(f"Selected {len(selected)} images; every candidate is within {covering:.1f} RGB of a selected one")
+    
+    collected_images = 0
+    per_breed = {}
+    for index in sorted(selected):
+        breed_count, breed_name, image_file = candidates[index]
+        i = per_breed.get(breed_count, 0)
+        per_breed[breed_count] = i + 1
+        output_name = f"dog_{breed_count:03d}_{breed_name}_{i:02d}.jpg"
+        try:
+            shutil.copy2(image_file, output_path / output_name)
+            collected_images += 1
+        except Exception as e:
+            print(f"  Failed to copy {image_file}: {e}")
+    
+    print(f"\nCollected {collected_images} dog images from {len(per_breed)} breeds")
+    return collected_images
+
+
+def collect_dog_images(stanford_path, output_dir, images_per_breed=2, total_images=200, selection='random',
+                       duplicate_distance=6, workers=None):
+    """Collect diverse high-quality dog images from Stanford Dogs dataset
+
+    With selection 'random', images_per_breed random images are taken from shuffled breeds.
+    With selection 'coverage', the total_images images covering the widest range of colours are
+    taken from all breeds, dropping near-duplicates (perceptual hashes within duplicate_distance bits).
+    """
     
     images_path = Path(stanford_path) / "versions/2/images/Images"
     output_path = Path(output_dir)
@@ -16,6 +133,9 @@ def collect_dog_images(stanford_path, output_dir, images_per_breed=2, total_imag
     breed_dirs = [d for d in images_path.iterdir() if d.is_dir()]
     print(f"Found {len(breed_dirs)} dog breeds")
     
+    if selection == 'coverage':
+        return collect_by_coverage(sorted(breed_dirs), output_path, total_images, duplicate_distance, workers)
+    
     # Shuffle breeds for variety
     random.shuffle(breed_dirs)
     
@@ -60,16 +180,35 @@ def collect_dog_images(stanford_path, output_dir, images_per_breed=2, total_imag
     print(f"\nCollected {collected_images} high-quality dog images from {breed_count} breeds")
     return collected_images
 
-if __name__ == "__main__":
-    stanford_dataset_path = "/Users/rauladell/.cache/kagglehub/datasets/jessicali9530/stanford-dogs-dataset"
-    output_directory = "stanford_dog_images"
+
+def main():
+    parser = argparse.ArgumentParser(description='Collect tile images from the Stanford Dogs dataset.')
+    parser.add_argument('--stanfordPath', type=str,
+                        default="/Users/rauladell/.cache/kagglehub/datasets/jessicali9530/stanford-dogs-dataset",
+                        help='path of the downloaded dataset')
+    parser.add_argument('--outputDir', type=str, default="stanford_dog_images", help='directory to copy images to')
+    parser.add_argument('--selection', choices=['random', 'coverage'], default='random',
+                        help='random images per breed, or the images covering the widest range of colours')
+    parser.add_argument('--imagesPerBreed', type=int, default=3, help='images per breed for random selection')
+    parser.add_argument('--totalImages', type=int, default=250, help='number of images to collect')
+    parser.add_argument('--duplicateDistance', type=int, default=6,
+                        help='perceptual hashes within this many bits are near-duplicates (coverage selection)')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all CPUs)')
+    parser.add_argument('--seed', type=int, default=42, help='random seed, for reproducible selection')
+    args = parser.parse_args()
     
     # Set random seed for reproducible selection
-    random.seed(42)
+    random.seed(args.seed)
     
     collect_dog_images(
-        stanford_path=stanford_dataset_path,
-        output_dir=output_directory,
-        images_per_breed=3,  # 3 images per breed for variety
-        total_images=250     # Collect more than needed for best selection
-    )
\ No newline at end of file
+        stanford_path=args.stanfordPath,
+        output_dir=args.outputDir,
+        images_per_breed=args.imagesPerBreed,
+        total_images=args.totalImages,
+        selection=args.selection,
+        duplicate_distance=args.duplicateDistance,
+        workers=args.workers
+    )
+
+if __name__ == "__main__":
+    main()
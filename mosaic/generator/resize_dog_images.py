@@ -1,89 +1,220 @@
 #!/usr/bin/env python3
 """
 Resize all dog images to a uniform square size for better mosaic generation.
+
+Images are decoded once each by a pool of worker processes, in JPEG draft mode at the
+smallest scale that still covers the largest requested size, and every requested size is
+cut from that one decode. A manifest in the output directory records the source files
+already processed, so later runs only process new or modified images.
 """
 
 from PIL import Image
+from multiprocessing import Pool
+import argparse
+import json
+import math
 import os
 import sys
+import time
+
+# Different size options - choose based on your needs
+SIZE_OPTIONS = {
+    'small': (50, 50),      # Small tiles, more detail in mosaic
+    'medium': (100, 100),   # Balanced option
+    'large': (200, 200),    # Larger tiles, dogs more visible
+    'xlarge': (400, 400)    # Very large tiles, dogs clearly visible
+}
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+MANIFEST_NAME = '.manifest.json'
 
-def resize_images(input_dir, output_dir, size=(100, 100)):
+
+def get_output_dirs(output_dir, sizes):
+    """
+    Return the directory each size is saved to: output_dir itself for a single size,
+    or a subdirectory per size name for several.
     """
-    Resize all images in input directory to specified size.
-    
+    if len(sizes) == 1:
+        return {name: output_dir for name in sizes}
+    return {name: os.path.join(output_dir, name) for name in sizes}
+
+
+def load_manifest(output_dir):
+    """Return the manifest of processed source files, or an empty one"""
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME)) as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_manifest(output_dir, manifest):
+    """Write the manifest atomically"""
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def resize_image(job):
+    """
+    Decode one image and save it at every requested size.
+
+    Args:
+        job: (input_path, outputs, quality), where outputs lists (output_path, (width, height))
+
+    Returns:
+        (input_path, error message or None)
+    """
+    input_path, outputs, quality = job
+    try:
+        with Image.open(input_path) as img:
+            image_format = img.format
+            # Let the JPEG decoder scale down while decoding, as far as the largest size allows
+            largest = max(max(size) for _, size in outputs)
+            width, height = img.size
+            scale = largest / min(width, height)
+            if scale < 1:
+                img.draft('RGB', (math.ceil(width * scale), math.ceil(height * scale)))
+
+            # Convert to RGB if necessary
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+
+            # Crop to a centered square
+            width, height = img.size
+            min_dimension = min(width, height)
+            left = (width - min_dimension) // 2
+            top = (height - min_dimension) // 2
+            img_cropped = img.crop((left, top, left + min_dimension, top + min_dimension))
+
+            # Resize to every target size from the same decode
+            for output_path, size in outputs:
+                img_resized = img_cropped.resize(size, Image.Resampling.LANCZOS)
+                img_resized.save(output_path + '.part', format=image_format or 'JPEG', quality=quality)
+                os.replace(output_path + '.part', output_path)
+        return input_path, None
+    except Exception as e:
+        return input_path, str(e)
+
+
+def resize_images(input_dir, output_dir, size=(100, 100), sizes=None, workers=None, quality=95, force=False,
+                  prune=False):
+    """
+    Resize all images in input directory to specified sizes, skipping the ones already done.
+
     Args:
         input_dir: Directory containing original images
         output_dir: Directory to save resized images
-        size: Target size as (width, height) tuple
+        size: Target size as (width, height) tuple, used when sizes isn't given
+        sizes: Dictionary of size name to (width, height); several sizes go to a subdirectory each
+        workers: Number of worker processes (defaults to the number of CPUs)
+        quality: JPEG quality of the saved images
+        force: Process every image, even if the manifest says it is up to date
+        prune: Delete outputs whose source image no longer exists
     """
-    # Create output directory if it doesn't exist
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    
-    # Process each image
-    processed = 0
-    for filename in os.listdir(input_dir):
-        if not filename.lower().endswith(('.png', '.jpg', '.jpeg')):
+    sizes = sizes or {f'{size[0]}x{size[1]}': tuple(size)}
+    output_dirs = get_output_dirs(output_dir, sizes)
+    for directory in output_dirs.values():
+        os.makedirs(directory, exist_ok=True)
+    manifest = {} if force else load_manifest(output_dir)
+
+    # Outputs are recorded by the directory they are written to, relative to output_dir, so a size
+    # only counts as done if the file there was written at that size
+    output_keys = {name: os.path.relpath(directory, output_dir) for name, directory in output_dirs.items()}
+
+    # Find images that are new, modified or missing one of the requested sizes
+    jobs, sources, skipped = [], {}, 0
+    for entry in sorted(os.scandir(input_dir), key=lambda entry: entry.name):
+        if not entry.is_file() or not entry.name.lower().endswith(IMAGE_EXTENSIONS):
             continue
-            
-        input_path = os.path.join(input_dir, filename)
-        output_path = os.path.join(output_dir, filename)
-        
-        try:
-            with Image.open(input_path) as img:
-                # Convert to RGB if necessary
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                
-                # Get current dimensions
-                width, height = img.size
-                
-                # Calculate crop to make square (center crop)
-                min_dimension = min(width, height)
-                left = (width - min_dimension) // 2
-                top = (height - min_dimension) // 2
-                right = left + min_dimension
-                bottom = top + min_dimension
-                
-                # Crop to square
-                img_cropped = img.crop((left, top, right, bottom))
-                
-                # Resize to target size
-                img_resized = img_cropped.resize(size, Image.Resampling.LANCZOS)
-                
-                # Save resized image
-                img_resized.save(output_path, quality=95)
+        stat = entry.stat()
+        source = {'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                  'outputs': {output_keys[name]: list(sizes[name]) for name in sizes}}
+        sources[entry.name] = source
+        previous = manifest.get(entry.name)
+        missing = [name for name in sizes if previous is None or previous['size'] != stat.st_size
+                   or previous['mtime'] != stat.st_mtime_ns
+                   or previous['outputs'].get(output_keys[name]) != list(sizes[name])
+                   or not os.path.exists(os.path.join(output_dirs[name], entry.name))]
+        if not missing:
+            skipped += 1
+            continue
+        outputs = [(os.path.join(output_dirs[name], entry.name), sizes[name]) for name in missing]
+        jobs.append((entry.path, outputs, quality))
+
+    if prune:
+        for filename in set(manifest) - set(sources):
+            for name in sizes:
+                path = os.path.join(output_dirs[name], filename)
+                if os.path.exists(path):
+                    os.remove(path)
+            del manifest[filename]
+
+    # Process each image
+    processed, failed = 0, 0
+    start = time.perf_counter()
+    with Pool(workers) as pool:
+        for input_path, error in pool.imap_unordered(resize_image, jobs, chunksize=max(1, min(64, len(jobs) // 64))):
+            filename = os.path.basename(input_path)
+            if error:
+                failed += 1
+                manifest.pop(filename, None)
+                print(f"\nError processing {filename}: {error}")
+            else:
                 processed += 1
-                
-                # Progress indicator
-                sys.stdout.write(f'\rProcessed {processed} images...')
-                sys.stdout.flush()
-                
-        except Exception as e:
-            print(f"\nError processing {filename}: {e}")
-    
-    print(f"\n\nSuccessfully resized {processed} images to {size[0]}x{size[1]} pixels")
+                previous = manifest.get(filename, {}).get('outputs', {})
+                # Keep the sizes done on earlier runs, if the source hasn't changed since
+                if manifest.get(filename, {}).get('mtime') != sources[filename]['mtime']:
+                    previous = {}
+                manifest[filename] = {**sources[filename], 'outputs': {**previous, **sources[filename]['outputs']}}
+                if processed % 500 == 0:
+                    save_manifest(output_dir, manifest)
+
+            # Progress indicator
+            sys.stdout.write(f'\rProcessed {processed + failed}/{len(jobs)} images...')
+            sys.stdout.flush()
+    save_manifest(output_dir, manifest)
+    elapsed = time.perf_counter() - start
+
+    size_names = ', '.join(f'{width}x{height}' for width, height in sizes.values())
+    print(f"\n\nSuccessfully resized {processed} images to {size_names} pixels in {elapsed:.1f}s "
+          f"({processed / max(elapsed, 1e-9):.0f} images/sec), {skipped} already up to date, {failed} failed")
     print(f"Saved to: {output_dir}")
 
+
+def parse_size(value):
+    """Return the (width, height) of a SIZE_OPTIONS name or a WIDTHxHEIGHT string"""
+    if value in SIZE_OPTIONS:
+        return value, SIZE_OPTIONS[value]
+    try:
+        width, height = (int(part) for part in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected one of {', '.join(SIZE_OPTIONS)} or WIDTHxHEIGHT, got {value}")
+    return value, (width, height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resize images to square tiles for the photo mosaic.')
+    parser.add_argument('input_dir', type=str, help='directory containing the original images')
+    parser.add_argument('output_dir', type=str, help='directory to save the resized images to')
+    parser.add_argument('--sizes', type=parse_size, nargs='+', default=[parse_size('medium')],
+                        help=f"sizes to make from each decode: {', '.join(SIZE_OPTIONS)} or WIDTHxHEIGHT "
+                             f"(several sizes are saved to a subdirectory each)")
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all CPUs)')
+    parser.add_argument('--quality', type=int, default=95, help='JPEG quality of the resized images')
+    parser.add_argument('--force', action='store_true', help='process every image, even those already up to date')
+    parser.add_argument('--prune', action='store_true', help='delete resized images whose original was removed')
+    args = parser.parse_args()
+
+    sizes = dict(args.sizes)
+    print(f"Resizing images to {', '.join(f'{width}x{height}' for width, height in sizes.values())} pixels...")
+    print(f"From: {args.input_dir}")
+    print(f"To: {args.output_dir}\n")
+
+    resize_images(args.input_dir, args.output_dir, sizes=sizes, workers=args.workers, quality=args.quality,
+                  force=args.force, prune=args.prune)
+
+
 if __name__ == "__main__":
-    # Configuration
-    INPUT_DIR = "/Users/rauladell/Work/Projects/blog/mosaic/generator/stanford_dog_images"
-    OUTPUT_DIR = "/Users/rauladell/Work/Projects/blog/mosaic/generator/stanford_dog_images_resized"
-    
-    # Different size options - choose based on your needs
-    SIZE_OPTIONS = {
-        'small': (50, 50),      # Small tiles, more detail in mosaic
-        'medium': (100, 100),   # Balanced option
-        'large': (200, 200),    # Larger tiles, dogs more visible
-        'xlarge': (400, 400)    # Very large tiles, dogs clearly visible
-    }
-    
-    # Choose size (change this to experiment)
-    chosen_size = 'medium'  # Change to 'small', 'large', or 'xlarge' as needed
-    TARGET_SIZE = SIZE_OPTIONS[chosen_size]
-    
-    print(f"Resizing dog images to {TARGET_SIZE[0]}x{TARGET_SIZE[1]} pixels...")
-    print(f"From: {INPUT_DIR}")
-    print(f"To: {OUTPUT_DIR}\n")
-    
-    resize_images(INPUT_DIR, OUTPUT_DIR, TARGET_SIZE)
\ No newline at end of file
+    main()
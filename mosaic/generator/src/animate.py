@@ -0,0 +1,138 @@
+from photomosaics import PhotoMosaic
+from outputs import OutputEncoder
+from batch import get_targets
+from run import add_options, get_mosaic_options, get_tile_source, instrumented
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from PIL import GifImagePlugin, Image, ImageSequence
+import argparse, os, time
+
+
+def get_frames(inputs: list):
+    """Yield (image, duration in ms or None) of every frame: all frames of an animated file, or one per still image.
+
+    Frames are decoded one at a time, so an animation is never held in memory as a whole.
+    """
+    for path in inputs:
+        with Image.open(path) as image:
+            for frame in ImageSequence.Iterator(image):
+                yield frame.convert('RGB'), frame.info.get('duration')
+
+
+class GifWriter:
+    """Write an animated GIF a frame at a time, so its frames are never held in memory together.
+
+    Pillow's save_all keeps every frame until the file is written; here each frame is quantized
+    to its own palette and appended as it comes. The file is written under a temporary name and
+    renamed into place on close.
+    """
+
+    def __init__(self, path: str, loop: int = 0):
+        self.path, self.loop = path, loop
+        self.file = open(path + '.part', 'wb')
+        self.frames = 0
+
+    def add(self, image: Image, duration: int):
+        """Append a frame shown for duration ms"""
+        frame = image.convert('P', palette=Image.Palette.ADAPTIVE)
+        if not self.frames:
+            header, _ = GifImagePlugin.getheader(frame, info={'loop': self.loop, 'duration': duration})
+            self.file.write(b''.join(header))
+        self.file.write(b''.join(GifImagePlugin.getdata(frame, duration=duration, include_color_table=True)))
+        self.frames += 1
+
+    def close(self):
+        """Finish the file, or drop it if no frame was added"""
+        if self.frames:
+            self.file.write(b';')
+        self.file.close()
+        if self.frames:
+            os.replace(self.path + '.part', self.path)
+        else:
+            os.remove(self.path + '.part')
+
+
+def save_frame(image: Image, path: str, imageFormat: str, options: dict, gif: GifWriter = None, gifWidth: int = None,
+               duration: int = None):
+    """Save a rendered frame, and append it to gif downscaled to gifWidth"""
+    OutputEncoder.save(image, path, imageFormat, options)
+    if gif:
+        width = min(gifWidth, image.width)
+        gif.add(image.resize((width, max(1, round(image.height * width / image.width))), Image.Resampling.LANCZOS,
+                             reducing_gap=3.0), duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert an animation or a sequence of frames to animated photo mosaics.')
+    parser.add_argument('imagesFolder', type=str,
+                        help='path to folder with images that will be used for photo mosaics, or a CIFAR dataset '
+                             'or exported .npy file to read tiles from as source[:label,label...], e.g. cifar10:dog')
+    parser.add_argument('frames', type=str, nargs='+',
+                        help='an animated GIF, WebP or PNG, or frame image files as paths or glob patterns such as '
+                             '"frames/*.png", in order')
+    parser.add_argument('--baseWidth', type=int, help='target width for the frames', nargs=1, default=[1000])
+    parser.add_argument('--step', type=int, help='height and width of sub-image in the frames', nargs=1, default=[20])
+    parser.add_argument('--threshold', type=float,
+                        help='distance in RGB a cell\'s average colour may move before its tile is matched again',
+                        nargs=1, default=[4.0])
+    parser.add_argument('--outFolder', type=str, help='folder to save the frames to', nargs=1, default=['out'])
+    parser.add_argument('--frameFormat', type=str, help='file format of the saved frames', nargs=1, default=['png'],
+                        choices=['png', 'jpg'])
+    parser.add_argument('--gifWidth', type=int, help='also save an animated GIF of the frames at this width',
+                        nargs=1, default=[None])
+    parser.add_argument('--fps', type=float, help='frame rate of the GIF when the input has no frame durations',
+                        nargs=1, default=[10.0])
+    add_options(parser)
+    args = parser.parse_args()
+    if args.stream or args.minStep[0] is not None:
+        parser.error('--stream and --minStep are not supported for animations')
+
+    with instrumented(args) as instrumentation:
+        inputs = get_targets(args.frames)
+        mosaic = PhotoMosaic(None, get_tile_source(args.imagesFolder), args.step[0], targetWidth=args.baseWidth[0],
+                             **get_mosaic_options(args, instrumentation))
+        name = os.path.splitext(os.path.basename(inputs[0]))[0]
+        folderName = os.path.join(args.outFolder[0], f"{name}-mosaic")
+        os.makedirs(folderName, exist_ok=True)
+        imageFormat, options = ('PNG', {'compress_level': args.compressLevel[0]}) if args.frameFormat[0] == 'png' \
+            else ('JPEG', {'quality': 90})
+
+        # Frames are encoded, and appended to the GIF, in order on a background thread while the next
+        # ones render; at most two wait to be written, so memory doesn't grow with the length of the animation
+        gifPath = os.path.join(folderName, f"{name}-mosaic.gif")
+        gif = GifWriter(gifPath) if args.gifWidth[0] else None
+        editedMatrix, pending = None, deque()
+        frames = changedCells = cells = 0
+        renderSeconds, start = 0.0, time.perf_counter()
+        with ThreadPoolExecutor(1) as executor:
+            for frame, (image, duration) in enumerate(get_frames(inputs)):
+                mosaic.set_frame(image, f"{name}-{frame:05d}")
+                renderStart = time.perf_counter()
+                editedMatrix, changed = mosaic.render_frame(editedMatrix, args.threshold[0], frame)
+                renderSeconds += time.perf_counter() - renderStart
+                frames, changedCells, cells = frames + 1, changedCells + changed, cells + mosaic.cellTiles.size
+                editedImage = Image.fromarray(editedMatrix.copy())
+                path = os.path.join(folderName, f"frame-{frame:05d}.{args.frameFormat[0]}")
+                pending.append(executor.submit(save_frame, editedImage, path, imageFormat, options, gif,
+                                               args.gifWidth[0], duration or round(1000 / args.fps[0])))
+                if len(pending) > 2:
+                    pending.popleft().result()
+                print(f"\rRendered frame {frame + 1}, {changed} of {mosaic.cellTiles.size} cells changed "
+                      f"({frames / renderSeconds:.1f} frames/sec rendering).", end='')
+            for future in pending:
+                future.result()
+        print()
+        if gif:
+            gif.close()
+        if not frames:
+            parser.error('no frames found')
+        if gif:
+            print(f"Animated GIF has been successfully saved to {gifPath}.")
+        elapsed = time.perf_counter() - start
+        print(f"Rendered {frames} frames ({mosaic.width}x{mosaic.height}) to {folderName} in {elapsed:.2f} s: "
+              f"{frames / renderSeconds:.1f} frames/sec rendering, {frames / elapsed:.1f} frames/sec with encoding, "
+              f"{1 - changedCells / cells:.1%} of cells reused from the previous frame.")
+
+
+if __name__ == '__main__':
+    main()
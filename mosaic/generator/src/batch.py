@@ -0,0 +1,77 @@
+from photomosaics import PhotoMosaic
+from run import add_options, check_options, get_encoder, get_mosaic_options, get_tile_source, instrumented
+import argparse, glob, os, time
+
+
+def get_targets(patterns: list) -> list:
+    """Return the image files named by a list of paths and glob patterns, in order and without repeats"""
+    targets = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if path not in targets:
+                targets.append(path)
+    return targets
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert many images to photo mosaics with one loaded tile library.')
+    parser.add_argument('imagesFolder', type=str,
+                        help='path to folder with images that will be used for photo mosaics, or a CIFAR dataset '
+                             'or exported .npy file to read tiles from as source[:label,label...], e.g. cifar10:dog')
+    parser.add_argument('targets', type=str, nargs='+',
+                        help='image files to convert, as paths or glob patterns such as "photos/*.jpg"')
+    parser.add_argument('--baseWidth', type=int, help='target widths for the photo mosaics, each rendered in turn',
+                        nargs='+', default=[5000])
+    parser.add_argument('--step', type=int, help='heights and widths of sub-image in the photo mosaics, each rendered in turn',
+                        nargs='+', default=[100])
+    parser.add_argument('--outFolder', type=str, help='folder to save the photo mosaics to',
+                        nargs=1, default=['out'])
+    add_options(parser)
+    args = parser.parse_args()
+    check_options(parser, args)
+
+    with instrumented(args) as instrumentation:
+        targets = get_targets(args.targets)
+        tileSource = get_tile_source(args.imagesFolder)
+        encoder = get_encoder(args)
+        settings = len(args.step) * len(args.baseWidth) > 1
+        results = []
+        for step in args.step:
+            # The library and match index only depend on the tile size, so they are built once per step
+            start = time.time()
+            mosaic = PhotoMosaic(None, tileSource, step, targetWidth=args.baseWidth[0],
+                                 **get_mosaic_options(args, instrumentation))
+            print(f"Loaded {len(mosaic.tiles)} tiles at step {step} in {time.time() - start:.2f} s.")
+            for baseWidth in args.baseWidth:
+                folderName = os.path.join(args.outFolder[0], f"step{step}-w{baseWidth}") if settings else args.outFolder[0]
+                for target in targets:
+                    start = time.time()
+                    try:
+                        mosaic.set_target(target, baseWidth)
+                        if not args.stream:
+                            mosaic.editedImage = mosaic.photo_mosaic()
+                        if args.lutError and mosaic.lut is not None:
+                            error = mosaic.lut_error()
+                            print(f"Lookup table matched {error['mismatched']:.2%} of {error['cells']} cells to a different "
+                                  f"tile, {error['meanExtraDistance']:.3f} further on average "
+                                  f"(at most {error['maxExtraDistance']:.3f}).")
+                        path = mosaic.save_image(args.pyramid, args.tileSize[0], folderName, encoder)
+                    except (OSError, ValueError) as error:
+                        print(f"Skipping {target}: {error}")
+                        results.append((target, step, baseWidth, None, time.time() - start))
+                        continue
+                    elapsed = time.time() - start
+                    print(f"{target} -> {path} ({mosaic.width}x{mosaic.height}) in {elapsed:.2f} s.")
+                    results.append((target, step, baseWidth, path, elapsed))
+
+    rendered = [result for result in results if result[3] is not None]
+    total = sum(elapsed for *_, elapsed in rendered)
+    print(f"Rendered {len(rendered)} of {len(results)} mosaics in {total:.2f} s"
+          + (f" ({total / len(rendered):.2f} s each)." if rendered else "."))
+    for target, step, baseWidth, path, elapsed in results:
+        print(f"  {target:<40} step {step:<4} width {baseWidth:<6} "
+              + (f"{elapsed:8.2f} s  {path}" if path else "failed"))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+from photomosaics import PhotoMosaic
+from PIL import Image
+from multiprocessing import Pipe, Process
+import numpy as np
+import argparse, contextlib, io, json, os, platform, subprocess, sys, tempfile, threading, time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+class MemorySampler:
+    """Track the peak resident set size of this process while a phase runs.
+
+    RSS is polled from /proc/self/statm on a background thread. Where that isn't available the
+    peak falls back to getrusage's ru_maxrss, which only ever grows, so it is the peak of the
+    whole run so far rather than of the phase. Worker processes are not included.
+    """
+
+    def __init__(self, interval: float = 0.002):
+        self.interval = interval
+        self.start = self.peak = self.rss()
+        self.running = False
+        self.thread = None
+
+    @staticmethod
+    def rss() -> int:
+        """Return the current resident set size in bytes"""
+        try:
+            with open('/proc/self/statm') as statm:
+                return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, AttributeError):
+            return MemorySampler.max_rss()
+
+    @staticmethod
+    def max_rss() -> int:
+        """Return the peak resident set size of this process so far in bytes, or 0 if unknown"""
+        if resource is None:
+            return 0
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+    def sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.rss())
+            time.sleep(self.interval)
+
+    def __enter__(self) -> 'MemorySampler':
+        self.start = self.peak = self.rss()
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, self.rss())
+
+
+class PhaseTimer:
+    """Collect wall time, peak RSS and throughput of named phases"""
+
+    def __init__(self):
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str, items: int = None, unit: str = None):
+        """Time the enclosed block as phase name; items processed per second is reported in unit/s"""
+        sampler = MemorySampler()
+        with sampler:
+            start = time.perf_counter()
+            result = {}
+            yield result
+            seconds = time.perf_counter() - start
+        items = result.get('items', items)
+        self.phases[name] = {'seconds': seconds, 'peakRss': sampler.peak, 'rssDelta': sampler.peak - sampler.start,
+                             'items': items, 'unit': unit,
+                             'throughput': items / seconds if items is not None and seconds > 0 else None}
+
+
+class TimedMosaic(PhotoMosaic):
+    """PhotoMosaic that times the library phases run by its constructor, under their names plus phaseSuffix"""
+
+    timer = None
+    phaseSuffix = ''
+
+    def load_images(self, folderPath, dimension: tuple) -> tuple:
+        with self.timer.phase('load_images' + self.phaseSuffix, unit='tiles') as result:
+            imageDictionary, tiles = super().load_images(folderPath, dimension)
+            result['items'] = len(tiles)
+        return imageDictionary, tiles
+
+    def build_index(self):
+        with self.timer.phase('build_index' + self.phaseSuffix, len(self.keyArray), 'keys'):
+            return super().build_index()
+
+    def get_lut(self) -> np.ndarray:
+        with self.timer.phase('get_lut' + self.phaseSuffix, self.lutSize ** 3, 'cells'):
+            return super().get_lut()
+
+
+def make_tiles(count: int, size: int, seed: int = 0) -> np.ndarray:
+    """Return a (count, size, size, 3) uint8 array of tiles with spread out average colours and some texture"""
+    rng = np.random.default_rng(seed)
+    tiles = np.empty((count, size, size, 3), dtype=np.uint8)
+    ramp = np.linspace(-1, 1, size)
+    for start in range(0, count, 1024):
+        chunk = min(1024, count - start)
+        colours = rng.uniform(16, 240, (chunk, 1, 1, 3))
+        gradients = rng.uniform(-16, 16, (chunk, 1, 1, 3)) * ramp[None, :, None, None]
+        noise = rng.normal(0, 8, (chunk, size, size, 3))
+        tiles[start:start + chunk] = np.clip(colours + gradients + noise, 0, 255).astype(np.uint8)
+    return tiles
+
+
+def write_tiles(tiles: np.ndarray, folder: str):
+    """Save tiles as JPEG files in folder"""
+    os.makedirs(folder, exist_ok=True)
+    for index, tile in enumerate(tiles):
+        Image.fromarray(tile).save(os.path.join(folder, f"tile{index:06d}.jpg"), quality=90)
+
+
+def make_target(path: str, width: int = 1200, height: int = 800, seed: int = 0):
+    """Save a smooth synthetic photo-like image to path, with gradients, blobs and noise"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width] / max(width, height)
+    image = np.stack([255 * x, 255 * y, 128 + 64 * np.sin(8 * x + 5 * y)], axis=2)
+    for cx, cy, radius, colour in zip(rng.uniform(0, 1, 12), rng.uniform(0, 1, 12), rng.uniform(0.03, 0.2, 12),
+                                      rng.uniform(0, 255, (12, 3))):
+        mask = ((x - cx * width / max(width, height)) ** 2 + (y - cy * height / max(width, height)) ** 2) < radius ** 2
+        image[mask] = 0.3 * image[mask] + 0.7 * colour
+    image += rng.normal(0, 6, image.shape)
+    Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).save(path)
+
+
+def run_config(config: dict, tileSource, targetPath: str, cacheDir: str) -> dict:
+    """Run every phase of one (tiles, step, targetWidth) configuration and return its measurements"""
+    timer = PhaseTimer()
+    TimedMosaic.timer = timer
+    TimedMosaic.phaseSuffix = ''
+    mosaic = TimedMosaic(None, tileSource, config['step'], config['targetWidth'], config['match'], cacheDir,
+                         workers=config['workers'], seed=0, lutSize=config['lutSize'],
+                         tileCacheSize=config['tileCache'])
+    if not isinstance(tileSource, np.ndarray):
+        # A second library load of the same folder is served by the feature cache; its phases are
+        # kept apart from the cold ones
+        TimedMosaic.phaseSuffix = '_cached'
+        mosaic = TimedMosaic(None, tileSource, config['step'], config['targetWidth'], config['match'], cacheDir,
+                             workers=config['workers'], seed=0, lutSize=config['lutSize'],
+                             tileCacheSize=config['tileCache'])
+
+    with timer.phase('get_matrix', unit='pixels') as result:
+        mosaic.set_target(targetPath)
+        result['items'] = mosaic.width * mosaic.height
+    with timer.phase('cell_averages', mosaic.width * mosaic.height, 'pixels'):
+        averages = mosaic.get_cell_averages(mosaic.matrix, mosaic.step)
+    with timer.phase('best_match', averages.shape[0] * averages.shape[1], 'cells'):
+        mosaic.best_matches(averages)
+    with timer.phase('photo_mosaic', mosaic.width * mosaic.height, 'pixels'):
+        mosaic.editedImage = mosaic.photo_mosaic()
+    return {**config, 'width': mosaic.width, 'height': mosaic.height, 'cells': int(averages.shape[0] * averages.shape[1]),
+            'libraryTiles': len(mosaic.tiles), 'phases': timer.phases}
+
+
+def run_isolated(connection, config: dict, tileSource, targetPath: str, cacheDir: str, verbose: bool):
+    """Process target: run one configuration and send back its result, or the error it raised"""
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with output:
+            result = run_config(config, tileSource, targetPath, cacheDir)
+        result['maxRss'] = MemorySampler.max_rss()
+        connection.send(result)
+    except Exception as error:
+        connection.send({**config, 'error': f"{type(error).__name__}: {error}"})
+    finally:
+        connection.close()
+
+
+def get_commit() -> str:
+    """Return the current git commit of the repository, or None outside a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, baselinePath: str, threshold: float) -> list:
+    """Print the time ratio of every phase against a previous run and return the regressions beyond threshold"""
+    with open(baselinePath) as file:
+        baseline = json.load(file)
+    key = lambda result: (result['tiles'], result['step'], result['targetWidth'], result['source'], result['match'])
+    previous = {key(result): result for result in baseline['results'] if 'phases' in result}
+    regressions = []
+    print(f"Compared with {baselinePath} (commit {baseline['meta'].get('commit')}):")
+    for result in results:
+        old = previous.get(key(result))
+        if old is None or 'phases' not in result:
+            continue
+        for name, phase in result['phases'].items():
+            if name not in old['phases'] or not old['phases'][name]['seconds']:
+                continue
+            ratio = phase['seconds'] / old['phases'][name]['seconds']
+            flag = '  SLOWER' if ratio > threshold else ''
+            print(f"  tiles {result['tiles']:<7} step {result['step']:<4} width {result['targetWidth']:<6} "
+                  f"{name:<20} {ratio:6.2f}x{flag}")
+            if flag:
+                regressions.append((key(result), name, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the phases of the photo mosaic generator on synthetic data.')
+    parser.add_argument('--tiles', type=int, help='tile library sizes to sweep, e.g. 1000 10000 100000',
+                        nargs='+', default=[1000, 10000])
+    parser.add_argument('--targetWidth', type=int, help='target widths to sweep, e.g. 1000 5000 20000',
+                        nargs='+', default=[1000, 5000])
+    parser.add_argument('--step', type=int, help='tile sizes in the mosaic to sweep', nargs='+', default=[20, 50])
+    parser.add_argument('--tileSize', type=int, help='width and height of the synthetic library tiles',
+                        nargs=1, default=[32])
+    parser.add_argument('--source', type=str,
+                        help='keep the library in memory as an array, or write it out as JPEG files to measure decoding '
+                             'and the feature cache', nargs=1, default=['array'], choices=['array', 'folder'])
+    parser.add_argument('--match', type=str, help='nearest tile search to benchmark',
+                        nargs=1, default=['kdtree'], choices=['kdtree', 'brute', 'lut'])
+    parser.add_argument('--lutSize', type=int, help='cells per channel of the lookup table for --match lut',
+                        nargs=1, default=[64])
+    parser.add_argument('--workers', type=int, help='number of worker processes', nargs=1, default=[1])
+    parser.add_argument('--tileCache', type=int, help='decode tiles on demand, keeping at most this many (folder source)',
+                        nargs=1, default=[None])
+    parser.add_argument('--output', type=str, help='JSON file to write results to (default benchmarks/<time>-<commit>.json)',
+                        nargs=1, default=[None])
+    parser.add_argument('--compare', type=str, help='previous results file to compare phase times with',
+                        nargs=1, default=[None])
+    parser.add_argument('--threshold', type=float, help='time ratio above which --compare reports a regression',
+                        nargs=1, default=[1.1])
+    parser.add_argument('--verbose', action='store_true', help="show the generator's own progress output")
+    args = parser.parse_args()
+
+    commit = get_commit()
+    meta = {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count(), 'args': vars(args)}
+    results = []
+    with tempfile.TemporaryDirectory(prefix='mosaic-benchmark-') as workDir:
+        targetPath = os.path.join(workDir, 'target.png')
+        make_target(targetPath)
+        for tileCount in args.tiles:
+            tiles = make_tiles(tileCount, args.tileSize[0])
+            tileSource = tiles
+            if args.source[0] == 'folder':
+                tileSource = os.path.join(workDir, f'tiles{tileCount}')
+                write_tiles(tiles, tileSource)
+                del tiles
+            for step in args.step:
+                for targetWidth in args.targetWidth:
+                    config = {'tiles': tileCount, 'step': step, 'targetWidth': targetWidth, 'source': args.source[0],
+                              'match': args.match[0], 'lutSize': args.lutSize[0], 'workers': args.workers[0], 'tileCache': args.tileCache[0]}
+                    # Each configuration runs in a fresh process, with a cold feature cache, so peak memory and
+                    # cache timings don't carry over from the previous one
+                    cacheDir = tempfile.mkdtemp(prefix='cache', dir=workDir)
+                    receiver, sender = Pipe(duplex=False)
+                    process = Process(target=run_isolated,
+                                      args=(sender, config, tileSource, targetPath, cacheDir, args.verbose))
+                    process.start()
+                    sender.close()
+                    try:
+                        result = receiver.recv()
+                    except EOFError:
+                        result = {**config, 'error': 'benchmark process exited unexpectedly'}
+                    process.join()
+                    results.append(result)
+                    if 'error' in result:
+                        print(f"tiles {tileCount:<7} step {step:<4} width {targetWidth:<6} failed: {result['error']}")
+                        continue
+                    print(f"tiles {tileCount:<7} step {step:<4} width {targetWidth:<6} "
+                          f"({result['width']}x{result['height']}, {result['cells']} cells), "
+                          f"max RSS {result['maxRss'] / 2 ** 20:.0f} MB")
+                    for name, phase in result['phases'].items():
+                        throughput = f"{phase['throughput']:14,.0f} {phase['unit']}/s" if phase['throughput'] else ''
+                        print(f"  {name:<20} {phase['seconds']:9.3f} s  peak {phase['peakRss'] / 2 ** 20:8.1f} MB  "
+                              f"{throughput}")
+
+    output = args.output[0] or os.path.join('benchmarks', time.strftime('%Y%m%d-%H%M%S') + (f'-{commit}' if commit else '')
+                                            + '.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump({'meta': meta, 'results': results}, file, indent=2)
+    print(f"Results have been saved to {output}.")
+    if args.compare[0] and compare(results, args.compare[0], args.threshold[0]):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
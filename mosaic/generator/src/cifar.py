@@ -5,12 +5,13 @@ logger.addHandler(handler)
 logger.propagate = False
 
 import hashlib
-import math
+import json
 import numpy as np
 import os
 import six
 import sys
 import tarfile
+import time
 import requests
 import pickle
 
@@ -20,7 +21,9 @@ except:
     from itertools import izip_longest as zip_longest
 
 from itertools import product
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 from pathlib import Path
 from PIL import Image
 from tqdm import tqdm
@@ -32,6 +35,12 @@ CIFAR100_TAR_FILENAME = 'cifar-100-python.tar.gz'
 CIFAR10_TAR_MD5  = 'c58f30108f718f92721af3b95e74349a'
 CIFAR100_TAR_MD5 = 'eb9058c3a382ffc7106e4002c42a8d85'
 
+CIFAR_MODE_SIZES = {
+    'cifar10': {'train': 50000, 'test': 10000},
+    'cifar100': {'train': 50000, 'test': 10000},
+    'cifar100superclass': {'train': 50000, 'test': 10000},
+}
+
 CIFAR10_TRAIN_DATA_NAMES = [
     'cifar-10-batches-py/data_batch_1',
     'cifar-10-batches-py/data_batch_2',
@@ -111,30 +120,131 @@ def check_output_path(output):
         sys.exit(1)
 
 
-# Reference: https://stackoverflow.com/questions/37573483/progress-bar-while-download-file-over-http-with-requests/37573701
-def download_with_progress(url, filename):
-    logger.warning("Downloading {}".format(filename))
-    r = requests.get(url, stream=True)
-    total_size = int(r.headers.get('content-length', 0))
-    block_size = 1024
-    wrote = 0
-    with open(filename, 'wb') as f:
-        for data in tqdm(r.iter_content(block_size), total=math.ceil(total_size//block_size) , unit='KB', unit_scale=True):
-            wrote = wrote  + len(data)
-            f.write(data)
+def file_md5(filename, block_size=1 << 20):
+    """Return the md5 hex digest of a file, read a block at a time"""
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def iter_download(url, offset=0, retries=5, block_size=1 << 16):
+    """Yield the bytes of url from offset on, resuming with a Range request after a dropped connection.
+
+    Raises IOError if the server answers a Range request with anything but partial content.
+    """
+    attempt = 0
+    while True:
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=30) as r:
+                if offset and r.status_code != 206:
+                    raise IOError("Server does not support resuming downloads of {} (status {})".format(
+                        url, r.status_code))
+                r.raise_for_status()
+                for data in r.iter_content(block_size):
+                    offset += len(data)
+                    yield data
+            return
+        except requests.exceptions.RequestException as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            logger.warning("Download interrupted ({}), resuming from byte {}".format(e, offset))
+            time.sleep(min(2 ** attempt, 30))
+
+
+def iter_download_ranges(url, offset, total, connections, chunk_size=8 << 20, retries=5):
+    """Yield the bytes of url from offset to total in order, fetching chunk_size ranges on parallel connections.
+
+    At most two chunks per connection are held in memory at a time.
+    """
+    def fetch(start, end):
+        for attempt in range(retries + 1):
+            try:
+                r = requests.get(url, headers={'Range': 'bytes={}-{}'.format(start, end)}, timeout=30)
+                if r.status_code == 206 and len(r.content) == end - start + 1:
+                    return r.content
+                raise requests.exceptions.RequestException(
+                    "unexpected response {} for bytes {}-{}".format(r.status_code, start, end))
+            except requests.exceptions.RequestException as e:
+                if attempt == retries:
+                    raise
+                logger.warning("Retrying bytes {}-{} ({})".format(start, end, e))
+                time.sleep(min(2 ** (attempt + 1), 30))
+
+    with ThreadPoolExecutor(connections) as executor:
+        pending = deque()
+        for start in range(offset, total, chunk_size):
+            pending.append(executor.submit(fetch, start, min(total, start + chunk_size) - 1))
+            if len(pending) >= 2 * connections:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def download_with_progress(url, filename, connections=1, chunk_size=8 << 20):
+    """Download url to filename and return its md5 hex digest, computed as the data arrives.
+
+    Data goes to filename.part first, so an interrupted download resumes from where it stopped
+    on the next call, using HTTP Range requests. With several connections, the rest of the
+    file is fetched as parallel ranges.
+    """
+    partname = filename + '.part'
+    md5 = hashlib.md5()
+    offset = 0
+    if os.path.exists(partname):
+        with open(partname, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                md5.update(block)
+                offset += len(block)
+
+    try:
+        head = requests.head(url, allow_redirects=True, timeout=30)
+        total_size = int(head.headers.get('content-length', 0)) if head.ok else 0
+        accepts_ranges = head.ok and head.headers.get('accept-ranges') == 'bytes'
+    except requests.exceptions.RequestException:
+        total_size, accepts_ranges = 0, False
+    if offset and (not accepts_ranges or (total_size and offset > total_size)):
+        offset = 0
+        md5 = hashlib.md5()
+    if offset:
+        logger.warning("Resuming {} from byte {}".format(filename, offset))
+    else:
+        logger.warning("Downloading {}".format(filename))
+
+    with open(partname, 'r+b' if offset else 'wb') as f:
+        f.seek(offset)
+        f.truncate()
+        if total_size and offset == total_size:
+            # The part file is already complete; asking for the bytes after it would get a 416
+            chunks = iter(())
+        elif connections > 1 and accepts_ranges and total_size:
+            chunks = iter_download_ranges(url, offset, total_size, connections, chunk_size)
+        else:
+            chunks = iter_download(url, offset)
+        with tqdm(total=total_size or None, initial=offset, unit='B', unit_scale=True) as progress:
+            for data in chunks:
+                f.write(data)
+                md5.update(data)
+                progress.update(len(data))
+        wrote = f.tell()
     if total_size != 0 and wrote != total_size:
         logger.error("ERROR, something went wrong")
         sys.exit(1)
+    os.replace(partname, filename)
+    return md5.hexdigest()
 
 
-def download_cifar(dataset):
+def download_cifar(dataset, connections=1):
     if dataset == 'cifar10':
-        download_with_progress(CIFAR10_URL, CIFAR10_TAR_FILENAME)
+        return download_with_progress(CIFAR10_URL, CIFAR10_TAR_FILENAME, connections)
     elif dataset in ['cifar100', 'cifar100superclass']:
-        download_with_progress(CIFAR100_URL, CIFAR100_TAR_FILENAME)
+        return download_with_progress(CIFAR100_URL, CIFAR100_TAR_FILENAME, connections)
 
 
-def check_cifar(dataset):
+def check_cifar(dataset, connections=1):
     if dataset == 'cifar10':
         cifar = Path(CIFAR10_TAR_FILENAME)
         md5sum = CIFAR10_TAR_MD5
@@ -144,9 +254,9 @@ def check_cifar(dataset):
 
     if not cifar.is_file():
         logger.warning("{} does not exists.".format(cifar))
-        download_cifar(dataset)
-
-    cifar_md5sum = hashlib.md5(cifar.open('rb').read()).hexdigest()
+        cifar_md5sum = download_cifar(dataset, connections)
+    else:
+        cifar_md5sum = file_md5(cifar)
     if md5sum != cifar_md5sum:
         logger.error("File `{0}` may be corrupted (wrong md5 checksum). Please delete `{0}` and retry".format(cifar))
         sys.exit(1)
@@ -186,81 +296,204 @@ def get_datanames(dataset, mode):
             return CIFAR100_TEST_DATA_NAMES
 
 
+def iter_cifar(dataset, mode):
+    """Yield (features, labels, coarse_labels, batch_name) for one batch at a time"""
+    TARFILE, label_data, label_labels, label_coarse = get_data_params(dataset)
+    datanames = get_datanames(dataset, mode)
+
+    try:
+        with tarfile.open(TARFILE) as tf:
+            for dataname in datanames:
+                ti = tf.getmember(dataname)
+                data = unpickle(tf.extractfile(ti))
+                features = np.asarray(data[label_data])
+                features = features.reshape(features.shape[0], 3, 32, 32)
+                features = features.transpose(0, 2, 3, 1).astype('uint8')
+                labels = np.asarray(data[label_labels])
+                coarse_labels = np.asarray(data[label_coarse]) if dataset == 'cifar100superclass' else []
+                yield features, labels, coarse_labels, dataname.split('/')[1]
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+
 def parse_cifar(dataset, mode):
     features = []
     labels = []
     coarse_labels = []
     batch_names = []
 
-    TARFILE, label_data, label_labels, label_coarse = get_data_params(dataset)
-    datanames = get_datanames(dataset, mode)
-
-    try:
-        tf = tarfile.open(TARFILE)
-        for dataname in datanames:
-            ti = tf.getmember(dataname)
-            data = unpickle(tf.extractfile(ti))
-            features.append(data[label_data])
-            labels.append(data[label_labels])
-            batch_names.extend([dataname.split('/')[1]] * len(data[label_data]))
-            if dataset == 'cifar100superclass':
-                coarse_labels.append(data[label_coarse])
-        features = np.concatenate(features)
-        features = features.reshape(features.shape[0], 3, 32, 32)
-        features = features.transpose(0, 2, 3, 1).astype('uint8')
-        labels = np.concatenate(labels)
+    for batch_features, batch_labels, batch_coarse_labels, batch_name in iter_cifar(dataset, mode):
+        features.append(batch_features)
+        labels.append(batch_labels)
+        batch_names.extend([batch_name] * len(batch_features))
         if dataset == 'cifar100superclass':
-            coarse_labels = np.concatenate(coarse_labels)
-    except KeyboardInterrupt:
-        sys.exit(1)
+            coarse_labels.append(batch_coarse_labels)
+    features = np.concatenate(features)
+    labels = np.concatenate(labels)
+    if dataset == 'cifar100superclass':
+        coarse_labels = np.concatenate(coarse_labels)
 
     return features, labels, coarse_labels, batch_names
 
 
-def save_cifar(args):
-    dataset = args.dataset
-    output = args.output
+def load_cifar_tiles(dataset, labels=None, modes=('train', 'test')):
+    """Return CIFAR images as a (N, 32, 32, 3) uint8 array, straight from the tarball.
+
+    labels optionally restricts them to the given label names (fine labels, or coarse
+    superclass labels for cifar100superclass).
+    """
+    check_cifar(dataset)
     if dataset == 'cifar10':
-        LABELS = CIFAR10_LABELS_LIST
         LABELS_LIST = CIFAR10_LABELS_LIST
-    elif dataset == 'cifar100':
-        LABELS = CIFAR100_LABELS_LIST
+    else:
         LABELS_LIST = CIFAR100_LABELS_LIST
+    if labels:
+        for label in labels:
+            if label not in LABELS_LIST and not (dataset == 'cifar100superclass' and label in CIFAR100_SUPERCLASS_LABELS_LIST):
+                logger.error("Unknown {} label `{}`".format(dataset, label))
+                sys.exit(1)
+        fine_indices = [LABELS_LIST.index(label) for label in labels if label in LABELS_LIST]
+        coarse_indices = [CIFAR100_SUPERCLASS_LABELS_LIST.index(label) for label in labels
+                          if label in CIFAR100_SUPERCLASS_LABELS_LIST]
+
+    tiles = []
+    for mode in modes:
+        features, labels_array, coarse_labels, _ = parse_cifar(dataset, mode)
+        if labels:
+            keep = np.isin(labels_array, fine_indices)
+            if dataset == 'cifar100superclass':
+                keep |= np.isin(coarse_labels, coarse_indices)
+            features = features[keep]
+        tiles.append(features)
+    return np.concatenate(tiles)
+
+
+def get_labels(dataset):
+    """Return (LABELS, LABELS_LIST, COARSE_LABELS_LIST): output directories, fine and coarse label names"""
+    if dataset == 'cifar10':
+        return CIFAR10_LABELS_LIST, CIFAR10_LABELS_LIST, None
+    elif dataset == 'cifar100':
+        return CIFAR100_LABELS_LIST, CIFAR100_LABELS_LIST, None
     elif dataset == 'cifar100superclass':
         LABELS = []
         for i in zip(CIFAR100_SUPERCLASS_LABELS_LIST, CIFAR100_CLASSES_LABELS_LIST):
             for j in product([i[0]], i[1]):
                 LABELS.append('/'.join(j))
-        LABELS_LIST = CIFAR100_LABELS_LIST
-        COARSE_LABELS_LIST = CIFAR100_SUPERCLASS_LABELS_LIST
+        return LABELS, CIFAR100_LABELS_LIST, CIFAR100_SUPERCLASS_LABELS_LIST
 
-    for mode in ['train', 'test']:
-        for label in LABELS:
-            dirpath = os.path.join(output, mode, label)
-            os.system("mkdir -p {}".format(dirpath))
-
-        features, labels , coarse_labels, batch_names = parse_cifar(dataset, mode)
-
-        label_count = defaultdict(int)
-        batch_count = defaultdict(int)
-        for feature, label, coarse_label, batch_name in tqdm(zip_longest(features, labels, coarse_labels, batch_names), total=len(labels), desc="Saving {} images".format(mode)):
-            label_count[label] += 1
-            if args.name_with_batch_index:
-                if args.dataset == 'cifar10':
-                    filename = '%s_index_%04d.png' % (batch_name, batch_count[batch_name])
-                else:
-                    filename = '%s_index_%05d.png' % (batch_name, batch_count[batch_name])
-            else:
-                filename = '%04d.png' % label_count[label]
-            batch_count[batch_name] += 1
 
+def save_pngs(job):
+    """Write a chunk of images to their PNG paths"""
+    features, filepaths = job
+    for feature, filepath in zip(features, filepaths):
+        Image.fromarray(feature).convert('RGB').save(filepath)
+    return len(filepaths)
+
+
+def save_cifar(args):
+    dataset = args.dataset
+    output = args.output
+    LABELS, LABELS_LIST, COARSE_LABELS_LIST = get_labels(dataset)
+
+    with Pool(args.workers) as pool:
+        for mode in ['train', 'test']:
+            for label in LABELS:
+                os.makedirs(os.path.join(output, mode, label), exist_ok=True)
+
+            label_count = defaultdict(int)
+            batch_count = defaultdict(int)
+            with tqdm(total=CIFAR_MODE_SIZES[dataset][mode], desc="Saving {} images".format(mode)) as progress:
+                # Workers write one batch's PNGs while the next batch is unpickled
+                pending = []
+                for features, labels, coarse_labels, batch_name in iter_cifar(dataset, mode):
+                    filepaths = []
+                    for label, coarse_label in zip_longest(labels, coarse_labels):
+                        label_count[label] += 1
+                        if args.name_with_batch_index:
+                            if args.dataset == 'cifar10':
+                                filename = '%s_index_%04d.png' % (batch_name, batch_count[batch_name])
+                            else:
+                                filename = '%s_index_%05d.png' % (batch_name, batch_count[batch_name])
+                        else:
+                            filename = '%04d.png' % label_count[label]
+                        batch_count[batch_name] += 1
+
+                        if dataset == 'cifar100superclass':
+                            filepaths.append(os.path.join(output, mode, COARSE_LABELS_LIST[coarse_label], LABELS_LIST[label], filename))
+                        else:
+                            filepaths.append(os.path.join(output, mode, LABELS_LIST[label], filename))
+                    jobs = [(features[i:i + 500], filepaths[i:i + 500]) for i in range(0, len(filepaths), 500)]
+                    for count in pending:
+                        progress.update(count)
+                    pending = pool.imap_unordered(save_pngs, jobs)
+                for count in pending:
+                    progress.update(count)
+
+
+def save_cifar_npy(args):
+    """Write each mode's images to a single memory-mappable <mode>.npy file with a label index.
+
+    <mode>_labels.npy (and <mode>_coarse_labels.npy for cifar100superclass) hold the label of
+    every image and labels.json the label names, so tools can read the images with
+    np.load(..., mmap_mode='r') and select labels without touching individual files.
+    """
+    dataset = args.dataset
+    output = args.output
+    _, LABELS_LIST, COARSE_LABELS_LIST = get_labels(dataset)
+    os.makedirs(output, exist_ok=True)
+    with open(os.path.join(output, 'labels.json'), 'w') as f:
+        json.dump({'dataset': dataset, 'labels': LABELS_LIST, 'coarse_labels': COARSE_LABELS_LIST}, f)
+
+    for mode in ['train', 'test']:
+        total = CIFAR_MODE_SIZES[dataset][mode]
+        images = np.lib.format.open_memmap(os.path.join(output, '{}.npy'.format(mode)), mode='w+',
+                                           dtype=np.uint8, shape=(total, 32, 32, 3))
+        labels = np.empty(total, dtype=np.int16)
+        coarse_labels = np.empty(total, dtype=np.int16)
+        written = 0
+        for features, batch_labels, batch_coarse_labels, _ in tqdm(iter_cifar(dataset, mode), total=len(get_datanames(dataset, mode)),
+                                                                   desc="Saving {} images".format(mode), unit='batch'):
+            images[written:written + len(features)] = features
+            labels[written:written + len(features)] = batch_labels
             if dataset == 'cifar100superclass':
-                filepath = os.path.join(output, mode, COARSE_LABELS_LIST[coarse_label], LABELS_LIST[label], filename)
-            else:
-                filepath = os.path.join(output, mode, LABELS_LIST[label], filename)
-            image = Image.fromarray(feature)
-            image = image.convert('RGB')
-            image.save(filepath)
+                coarse_labels[written:written + len(features)] = batch_coarse_labels
+            written += len(features)
+        if written != total:
+            logger.error("Expected {} {} images, found {}".format(total, mode, written))
+            sys.exit(1)
+        images.flush()
+        del images
+        np.save(os.path.join(output, '{}_labels.npy'.format(mode)), labels)
+        if dataset == 'cifar100superclass':
+            np.save(os.path.join(output, '{}_coarse_labels.npy'.format(mode)), coarse_labels)
+
+
+def load_exported_tiles(path, labels=None):
+    """Return the images of a .npy file written by save_cifar_npy, memory-mapped, optionally only those with the given label names.
+
+    Selecting labels copies the matching images into memory, since indexing a memory map by a
+    list of rows doesn't give a memory map.
+    """
+    images = np.load(path, mmap_mode='r')
+    if not labels:
+        return images
+    output, filename = os.path.split(path)
+    mode = os.path.splitext(filename)[0]
+    with open(os.path.join(output, 'labels.json')) as f:
+        index = json.load(f)
+    for label in labels:
+        if label not in index['labels'] and label not in (index['coarse_labels'] or []):
+            logger.error("Unknown {} label `{}`".format(path, label))
+            sys.exit(1)
+    keep = np.zeros(len(images), dtype=bool)
+    fine_labels = np.load(os.path.join(output, '{}_labels.npy'.format(mode)))
+    keep |= np.isin(fine_labels, [index['labels'].index(label) for label in labels if label in index['labels']])
+    if index['coarse_labels']:
+        coarse_labels = np.load(os.path.join(output, '{}_coarse_labels.npy'.format(mode)))
+        keep |= np.isin(coarse_labels, [index['coarse_labels'].index(label) for label in labels
+                                        if label in index['coarse_labels']])
+    return images[np.flatnonzero(keep)]
+
 
 def main(argv=sys.argv[1:]):
     import argparse
@@ -273,12 +506,21 @@ def main(argv=sys.argv[1:]):
         help="Path to save PNG converted dataset.")
     parser.add_argument("--name-with-batch-index", action="store_true",
         help="name image files based on batch name and index of cifar10/cifar100 dataset")
+    parser.add_argument("--format", type=str, choices=['png', 'npy'], default='png',
+        help="png: one file per image. npy: one memory-mappable array per mode plus a label index")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+        help="number of processes writing PNG files")
+    parser.add_argument("--connections", type=int, default=1,
+        help="number of parallel range requests used to download the dataset")
     args = parser.parse_args()
 
     check_output_path(args.output)
 
-    if check_cifar(args.dataset):
-        save_cifar(args)
+    if check_cifar(args.dataset, args.connections):
+        if args.format == 'npy':
+            save_cifar_npy(args)
+        else:
+            save_cifar(args)
 
 
 if __name__ == '__main__':
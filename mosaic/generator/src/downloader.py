@@ -0,0 +1,147 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+from PIL import Image
+import hashlib, io, os, random, threading, time
+import requests
+
+
+class Downloader:
+    """Download images concurrently into a folder, skipping duplicates.
+
+    URLs are fetched by a pool of `connections` threads, each reusing its own HTTP session,
+    with at most `perHost` requests to the same host at a time. Failed requests, timeouts and
+    429 / 5xx responses are retried with exponential backoff. Files are named
+    <prefix>-<n>.<extension> like before, written to a temporary file and renamed into place,
+    and skipped when their contents hash to those of a file already in the folder. With
+    thumbnail set to (width, height), images are center-cropped to a square and thumbnailed
+    as they arrive, so only tile-sized JPEGs are saved.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, folder: str, prefix: str, connections: int = 8, perHost: int = 4, retries: int = 4,
+                 backoff: float = 0.5, timeout: float = 30, thumbnail: tuple = None):
+        self.folder, self.prefix = folder, prefix
+        self.connections, self.perHost = max(1, connections), max(1, perHost)
+        self.retries, self.backoff, self.timeout = retries, backoff, timeout
+        self.thumbnail = thumbnail
+        self.lock = threading.Lock()
+        self.hostLimits = {}
+        self.sessions = threading.local()
+        self.counter = 0
+        os.makedirs(folder, exist_ok=True)
+        self.hashes = {self.file_hash(os.path.join(folder, name)): name for name in sorted(os.listdir(folder))
+                       if os.path.isfile(os.path.join(folder, name)) and not name.endswith('.part')}
+
+    @staticmethod
+    def file_hash(path: str) -> str:
+        """Return the hex sha256 digest of a file's contents"""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def get_session(self) -> requests.Session:
+        """Return this thread's session, so its connections are reused between downloads"""
+        session = getattr(self.sessions, 'session', None)
+        if session is None:
+            session = self.sessions.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=self.connections, pool_maxsize=self.perHost)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        return session
+
+    def host_limit(self, url: str) -> threading.Semaphore:
+        """Return the semaphore bounding the concurrent requests to url's host"""
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.hostLimits:
+                self.hostLimits[host] = threading.Semaphore(self.perHost)
+            return self.hostLimits[host]
+
+    def fetch(self, url: str) -> bytes:
+        """Return the body of url, retrying failures with exponential backoff and jitter"""
+        for attempt in range(self.retries + 1):
+            try:
+                with self.host_limit(url):
+                    response = self.get_session().get(url, timeout=self.timeout)
+                if response.status_code not in self.RETRY_STATUSES:
+                    response.raise_for_status()
+                    return response.content
+                error = requests.HTTPError(f"{response.status_code} for {url}", response=response)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as exception:
+                error = exception
+            if attempt == self.retries:
+                raise error
+            time.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+
+    def next_name(self, extension: str) -> str:
+        """Return the next unused <prefix>-<n>.<extension> name in the folder"""
+        with self.lock:
+            while True:
+                name = f'{self.prefix}-{self.counter}.{extension}'
+                self.counter += 1
+                if not os.path.exists(os.path.join(self.folder, name)):
+                    return name
+
+    def prepare(self, content: bytes) -> bytes:
+        """Return the bytes to save for a download: thumbnailed to tile size if requested, else as they came"""
+        if not self.thumbnail:
+            return content
+        with Image.open(io.BytesIO(content)) as image:
+            image.draft('RGB', (self.thumbnail[0] * 2, self.thumbnail[1] * 2))
+            width, height = image.size
+            side = min(width, height)
+            image = image.crop(((width - side) // 2, (height - side) // 2, (width + side) // 2, (height + side) // 2))
+            image.thumbnail(self.thumbnail)
+            output = io.BytesIO()
+            image.convert('RGB').save(output, 'JPEG', quality=90)
+            return output.getvalue()
+
+    def download_one(self, url: str) -> tuple:
+        """Download url and return (url, status, file name), where status is 'saved' or 'duplicate'"""
+        content = self.fetch(url)
+        contentHash = hashlib.sha256(content).hexdigest()
+        with self.lock:
+            duplicate = self.hashes.get(contentHash)
+            if duplicate is None:
+                # Claim the hash now, so a concurrent download of the same image is skipped too
+                self.hashes[contentHash] = ''
+        if duplicate is not None:
+            return url, 'duplicate', duplicate
+        try:
+            data = self.prepare(content)
+            name = self.next_name('jpg')
+            path = os.path.join(self.folder, name)
+            with open(path + '.part', 'wb') as file:
+                file.write(data)
+            os.replace(path + '.part', path)
+        except Exception:
+            with self.lock:
+                del self.hashes[contentHash]
+            raise
+        with self.lock:
+            self.hashes[contentHash] = name
+            # Thumbnails differ from the download, so also recognise a later copy of the saved file itself
+            self.hashes.setdefault(hashlib.sha256(data).hexdigest(), name)
+        return url, 'saved', name
+
+    def download(self, urls, progress=None) -> list:
+        """Download every distinct URL and return (url, status, file name or error) for each, in completion order.
+
+        progress(done, total, result) is called after each one finishes.
+        """
+        urls = list(dict.fromkeys(urls))
+        results = []
+        with ThreadPoolExecutor(self.connections) as executor:
+            futures = {executor.submit(self.download_one, url): url for url in urls}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except (requests.RequestException, OSError, Image.DecompressionBombError) as error:
+                    result = (futures[future], 'failed', str(error))
+                results.append(result)
+                if progress:
+                    progress(len(results), len(urls), result)
+        return results
@@ -0,0 +1,243 @@
+import numpy as np
+import glob, hashlib, os, uuid, zipfile
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# Features with these prefixes are stored in .npy files of their own, read memory-mapped
+MAPPED_PREFIXES = ('tiles@',)
+
+
+class FeatureStore:
+    """Binary cache of per-tile features for one image folder.
+
+    Everything is kept in a single uncompressed .npz file in cacheDir (never inside the image
+    folder), named after the folder and a hash of its absolute path. Each row belongs to one
+    file and is identified by its name, size and modification time, plus a hash of its
+    contents when hashContent is set. Features are stored side by side under names such as
+    'mean@100' or 'tiles@32', each with a mask of the rows where it has been computed.
+    Features are only read from disk when first asked for, so a large feature that isn't
+    needed (such as tile pixels when they are decoded on demand) is never loaded.
+
+    Tile pixels ('tiles@...') are kept out of the .npz, in one .npy file per size next to it,
+    which is memory-mapped rather than read: opening an unchanged library takes no time or
+    memory whatever its size, and any number of processes can map the same file. Each save
+    writes them to a new file named by a generation recorded in the .npz, so replacing the
+    .npz switches to the new files at once and processes still mapping the old ones are
+    unaffected.
+    """
+
+    def __init__(self, folderPath: str, cacheDir: str = 'cache', hashContent: bool = False):
+        self.folderPath = os.path.abspath(folderPath)
+        self.hashContent = hashContent
+        folder = os.path.basename(os.path.normpath(self.folderPath))
+        folderHash = hashlib.sha1(self.folderPath.encode()).hexdigest()[:10]
+        self.path = os.path.join(cacheDir, '_'.join(folder.lower().split()) + f'-{folderHash}.npz')
+        self.names, self.sizes, self.mtimes, self.hashes = [], np.empty(0, np.int64), np.empty(0, np.int64), []
+        # Features not read yet are None; rowMap maps current rows to rows on disk (-1 for new ones)
+        self.features, self.masks = {}, {}
+        # Generation of the file on disk of every mapped feature, and the features put() since saving
+        self.generations, self.changed = {}, set()
+        self.data, self.rowMap, self.diskRows = None, None, 0
+        self.updated = False
+        self.load()
+
+    def load(self):
+        """Open the store on disk if it exists, reading everything but the features themselves"""
+        try:
+            self.data = np.load(self.path)
+            names, sizes, mtimes, hashes = self.data['names'], self.data['sizes'], self.data['mtimes'], self.data['hashes']
+            masks = {key[len('mask:'):]: self.data[key] for key in self.data.files if key.startswith('mask:')}
+            generations = {key[len('mapped:'):]: str(self.data[key]) for key in self.data.files
+                           if key.startswith('mapped:')}
+        except (FileNotFoundError, KeyError, ValueError, zipfile.BadZipFile):
+            self.close()
+            return
+        self.names, self.sizes, self.mtimes, self.hashes = names.tolist(), sizes, mtimes, hashes.tolist()
+        self.masks, self.generations = masks, generations
+        self.diskRows = len(self.names)
+        self.features = {name: None for name in masks}
+        # Stores from before mapped features existed hold them in the .npz; move them out on save
+        if any(self.is_mapped(name) and name not in generations for name in masks):
+            self.updated = True
+
+    @staticmethod
+    def is_mapped(name: str) -> bool:
+        """Return whether a feature is stored in a memory-mapped file of its own"""
+        return name.startswith(MAPPED_PREFIXES)
+
+    def feature_path(self, name: str, generation: str) -> str:
+        """Return the path of the file of a mapped feature"""
+        return f"{os.path.splitext(self.path)[0]}.{name}.{generation}.npy"
+
+    def close(self):
+        """Close the file on disk; features not read by now are no longer available"""
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+    def read_feature(self, name: str) -> np.ndarray:
+        """Return a feature from the file on disk, with its rows in line with the current ones"""
+        if name in self.generations:
+            values = np.load(self.feature_path(name, self.generations[name]), mmap_mode='r')
+        else:
+            values = self.data['feature:' + name]
+        if self.same_rows():
+            return values
+        remapped = np.zeros((len(self.rowMap),) + values.shape[1:], values.dtype)
+        kept = self.rowMap >= 0
+        remapped[kept] = values[self.rowMap[kept]]
+        return remapped
+
+    def same_rows(self) -> bool:
+        """Return whether the current rows are still those on disk"""
+        return self.rowMap is None or (len(self.rowMap) == self.diskRows
+                                       and (self.rowMap == np.arange(self.diskRows)).all())
+
+    def load_feature(self, name: str) -> np.ndarray:
+        """Return a feature, reading it from disk the first time it is needed"""
+        if self.features[name] is None:
+            self.features[name] = self.read_feature(name)
+        return self.features[name]
+
+    def save(self):
+        """Write the store to disk atomically, if anything changed since it was loaded.
+
+        Arrays are written one at a time, and features that were never read are copied over
+        one at a time too, so saving doesn't need every feature in memory at once. Mapped
+        features are written to new files, in chunks, unless they haven't changed.
+        """
+        if not self.updated:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        arrays = {'names': np.array(self.names, dtype=str), 'sizes': self.sizes, 'mtimes': self.mtimes,
+                  'hashes': np.array(self.hashes, dtype=str)}
+        temporaryPath = self.path + '.tmp.npz'
+        generations = {name: self.save_mapped(name) for name in self.features if self.is_mapped(name)}
+        with zipfile.ZipFile(temporaryPath, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+            members = list(arrays.items())
+            for name in self.features:
+                members.append(('mask:' + name, self.masks[name]))
+                if name in generations:
+                    members.append(('mapped:' + name, np.array(generations[name])))
+                else:
+                    members.append(('feature:' + name, name))
+            for key, array in members:
+                if isinstance(array, str):
+                    array = self.features[array] if self.features[array] is not None else self.read_feature(array)
+                with archive.open(key + '.npy', 'w', force_zip64=True) as member:
+                    np.lib.format.write_array(member, np.asanyarray(array), allow_pickle=False)
+        self.close()
+        os.replace(temporaryPath, self.path)
+        self.data, self.rowMap, self.diskRows = np.load(self.path), None, len(self.names)
+        self.generations, self.changed = generations, set()
+        self.updated = False
+        for name in generations:
+            # Map the saved file rather than keep a copy in memory, and remove older generations
+            self.features[name] = None
+            for path in glob.glob(glob.escape(self.feature_path(name, '')[:-len('.npy')]) + '*.npy'):
+                if path != self.feature_path(name, generations[name]):
+                    try:
+                        os.remove(path)
+                    except OSError:  # still mapped, on Windows
+                        pass
+
+    def save_mapped(self, name: str) -> str:
+        """Write a mapped feature to a new file if it changed since it was read, and return its generation"""
+        if name in self.generations and name not in self.changed and self.same_rows():
+            return self.generations[name]
+        values = self.features[name] if self.features[name] is not None else self.read_feature(name)
+        generation = uuid.uuid4().hex[:12]
+        mapped = np.lib.format.open_memmap(self.feature_path(name, generation), 'w+', values.dtype, values.shape)
+        for start in range(0, len(values), 1024):
+            mapped[start:start + 1024] = values[start:start + 1024]
+        mapped.flush()
+        del mapped
+        return generation
+
+    def scan(self) -> list:
+        """Return (name, size, mtime) of every image file in the folder, sorted by name"""
+        entries = []
+        for entry in os.scandir(self.folderPath):
+            if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                stat = entry.stat()
+                entries.append((entry.name, stat.st_size, stat.st_mtime_ns))
+        return sorted(entries)
+
+    @staticmethod
+    def file_hash(path: str) -> str:
+        """Return the hex digest of a file's contents"""
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def update(self) -> list:
+        """Bring the rows in line with the folder's current files and return their names.
+
+        Rows of unchanged files keep their features, rows of removed files are dropped and new
+        or modified files get empty rows to be filled in with put().
+        """
+        entries = self.scan()
+        previousRows = {name: row for row, name in enumerate(self.names)}
+        rows, hashes = [], []
+        for name, size, mtime in entries:
+            row = previousRows.get(name, -1)
+            contentHash = self.file_hash(os.path.join(self.folderPath, name)) if self.hashContent else ''
+            if row >= 0:
+                if self.hashContent and self.hashes[row]:
+                    unchanged = self.hashes[row] == contentHash
+                else:
+                    unchanged = self.sizes[row] == size and self.mtimes[row] == mtime
+                if not unchanged:
+                    row = -1
+                elif not self.hashContent:
+                    contentHash = self.hashes[row]
+            rows.append(row)
+            hashes.append(contentHash)
+
+        rows = np.array(rows, dtype=np.intp)
+        sizes = np.array([size for _, size, _ in entries], dtype=np.int64)
+        mtimes = np.array([mtime for _, _, mtime in entries], dtype=np.int64)
+        if (len(rows) != len(self.names) or (rows != np.arange(len(rows))).any() or hashes != self.hashes
+                or (sizes != self.sizes).any() or (mtimes != self.mtimes).any()):
+            self.updated = True
+        kept = rows >= 0
+        for name in self.features:
+            masks = np.zeros(len(rows), dtype=bool)
+            masks[kept] = self.masks[name][rows[kept]]
+            self.masks[name] = masks
+            if self.features[name] is not None:
+                features = np.zeros((len(rows),) + self.features[name].shape[1:], self.features[name].dtype)
+                features[kept] = self.features[name][rows[kept]]
+                self.features[name] = features
+        # Features still on disk are remapped when they are read
+        self.rowMap = rows if self.rowMap is None else np.where(kept, self.rowMap[np.maximum(rows, 0)], -1)
+        self.names = [name for name, _, _ in entries]
+        self.sizes, self.mtimes = sizes, mtimes
+        self.hashes = hashes
+        return self.names
+
+    def get(self, name: str) -> tuple:
+        """Return (values, mask) of a feature, where mask marks the rows already computed"""
+        if name not in self.features:
+            return None, np.zeros(len(self.names), dtype=bool)
+        return self.load_feature(name), self.masks[name]
+
+    def get_mask(self, name: str) -> np.ndarray:
+        """Return the mask of the rows where a feature has been computed, without reading the feature"""
+        return self.masks.get(name, np.zeros(len(self.names), dtype=bool))
+
+    def put(self, name: str, rows, values: np.ndarray):
+        """Store values of a feature for the given rows"""
+        values = np.asarray(values)
+        if name not in self.features:
+            self.features[name] = np.zeros((len(self.names),) + values.shape[1:], values.dtype)
+            self.masks[name] = np.zeros(len(self.names), dtype=bool)
+        if not self.load_feature(name).flags.writeable:  # memory-mapped from disk
+            self.features[name] = np.array(self.features[name])
+        self.features[name][rows] = values
+        self.masks[name][rows] = True
+        self.changed.add(name)
+        self.updated = True
@@ -0,0 +1,144 @@
+import json, os, sys, threading, time, tracemalloc
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+class _NullPhase:
+    """Phase handle of disabled instrumentation, which ignores everything it is given"""
+
+    def __enter__(self) -> '_NullPhase':
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setitem__(self, key, value):
+        pass
+
+    def update(self, *args, **fields):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class Instrumentation:
+    """Emit structured phase events to a list of sinks.
+
+    Code being measured wraps each phase in `with instrumentation.phase(name) as phase:` and
+    may set fields on it (counts, sizes, cache hits) with phase[key] = value. Every sink is a
+    callable receiving a dict for the start and the end of each phase; end events carry the
+    duration, current and peak RSS and, when tracemalloc is tracing, the peak traced memory
+    of the phase. With no sinks every call is a no-op returning a shared dummy phase. Phases
+    nest per thread, so threads rendering at the same time each get their own parents.
+    """
+
+    def __init__(self, sinks: list = None):
+        self.sinks = list(sinks or [])
+        self.local = threading.local()
+
+    @property
+    def stack(self) -> list:
+        """Return the phases open in the calling thread, innermost last"""
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.sinks)
+
+    def phase(self, name: str, **fields):
+        """Return a context manager measuring the phase name"""
+        if not self.sinks:
+            return _NULL_PHASE
+        return _Phase(self, name, fields)
+
+    def emit(self, event: dict):
+        for sink in self.sinks:
+            sink(event)
+
+    def close(self):
+        """Close every sink that has a close method"""
+        for sink in self.sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+
+    @staticmethod
+    def memory() -> dict:
+        """Return the current and peak resident set size of this process in bytes, where available"""
+        memory = {}
+        try:
+            with open('/proc/self/statm') as statm:
+                memory['rss'] = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, AttributeError):
+            pass
+        if resource is not None:
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            memory['maxRss'] = maxrss if sys.platform == 'darwin' else maxrss * 1024
+        return memory
+
+
+class _Phase(dict):
+    """Phase handle of enabled instrumentation; the fields set on it are sent with its end event"""
+
+    def __init__(self, instrumentation: Instrumentation, name: str, fields: dict):
+        super().__init__(fields)
+        self.instrumentation, self.name = instrumentation, name
+
+    def __enter__(self) -> '_Phase':
+        stack = self.instrumentation.stack
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.instrumentation.emit({'event': 'start', 'phase': self.name, 'parent': self.parent, 'time': time.time(),
+                                   **self})
+        self.tracing = tracemalloc.is_tracing()
+        if self.tracing:
+            # Resetting the peak for this phase must not lose the enclosing phase's peak so far
+            self.tracedStart, peak = tracemalloc.get_traced_memory()
+            if self.parent is not None:
+                stack[-2].tracedPeak = max(getattr(stack[-2], 'tracedPeak', 0), peak)
+            tracemalloc.reset_peak()
+            self.tracedPeak = self.tracedStart
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        seconds = time.perf_counter() - self.start
+        event = {'event': 'end', 'phase': self.name, 'parent': self.parent, 'time': time.time(), 'seconds': seconds,
+                 **self.instrumentation.memory(), **self}
+        stack = self.instrumentation.stack
+        if self.tracing and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], self.tracedPeak)
+            event['tracedPeak'] = peak - self.tracedStart
+            if len(stack) > 1:
+                stack[-2].tracedPeak = max(getattr(stack[-2], 'tracedPeak', 0), peak)
+        if excType is not None:
+            event['error'] = f"{excType.__name__}: {exc}"
+        stack.pop()
+        self.instrumentation.emit(event)
+        return False
+
+
+class JsonLinesSink:
+    """Write every event as one line of JSON to a file, flushed as it goes so a running job can be followed"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def __call__(self, event: dict):
+        line = json.dumps(event, default=str) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+NULL_INSTRUMENTATION = Instrumentation()
@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import itertools, os, time
+
+# Encoder settings of the downscaled outputs, chosen for page weight against encode time: WebP
+# method 6 saves ~10% over method 4 at ~3x the time, progressive optimized JPEG saves ~10% over
+# baseline for a few milliseconds at preview size
+OUTPUT_FORMATS = {
+    'webp': ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('jpg', 'JPEG', {'quality': 85, 'progressive': True, 'optimize': True}),
+    'thumb': ('jpg', 'JPEG', {'quality': 80, 'progressive': True, 'optimize': True}),
+}
+
+
+class OutputEncoder:
+    """Encode a finished mosaic into several files at once.
+
+    Outputs are 'full', the mosaic at full size in its own format (PNG at zlib level
+    compressLevel), web previews 'webp' and 'jpeg' at most previewWidth wide, and a 'thumb'
+    at most thumbWidth wide. Each smaller image is resized from the next larger one, and
+    every file is encoded on a thread pool; Pillow releases the GIL while encoding, so the
+    encodes run in parallel without copying the mosaic. Files are written under a temporary
+    name and renamed into place.
+    """
+
+    def __init__(self, outputs: tuple = ('full',), previewWidth: int = 2048, thumbWidth: int = 400,
+                 compressLevel: int = 3):
+        unknown = set(outputs) - {'full'} - set(OUTPUT_FORMATS)
+        if unknown:
+            raise ValueError(f"unknown outputs {', '.join(sorted(unknown))}")
+        self.outputs = tuple(dict.fromkeys(outputs))
+        self.previewWidth, self.thumbWidth = previewWidth, thumbWidth
+        self.compressLevel = compressLevel
+
+    def get_width(self, output: str) -> int:
+        """Return the largest width of an output, or None for full size"""
+        return {'full': None, 'thumb': self.thumbWidth}.get(output, self.previewWidth)
+
+    def get_suffix(self, output: str, width: int) -> str:
+        """Return what an output adds to the file name of a mosaic width wide; previews are named by
+        the width they are written at"""
+        return {'full': '', 'thumb': '-thumb'}.get(output, f'-{min(self.previewWidth, width)}')
+
+    def get_paths(self, folder: str, name: str, extension: str, width: int) -> dict:
+        """Return the path of every output of a mosaic width wide, as <name>-mosaic[<n>]<suffix>.<extension>
+        with the first n for which none of them exists yet"""
+        existing = set(os.listdir(folder))
+        for counter in itertools.chain([''], itertools.count()):
+            names = {output: f"{name}-mosaic{counter}{self.get_suffix(output, width)}."
+                             f"{extension if output == 'full' else OUTPUT_FORMATS[output][0]}"
+                     for output in self.outputs}
+            if existing.isdisjoint(names.values()):
+                return {output: os.path.join(os.path.abspath(folder), fileName) for output, fileName in names.items()}
+
+    def encode(self, image: Image, paths: dict, alongside=None) -> dict:
+        """Save image to the path of every output in paths, and return (bytes, seconds) of each.
+
+        alongside, if given, is called once every encode has started, to do other work meanwhile.
+        """
+        scaled = {}
+        with ThreadPoolExecutor(max(1, len(paths))) as executor:
+            futures = {}
+            # Widest first, so every resize starts from the smallest image that covers it
+            for output in sorted(paths, key=lambda output: -(self.get_width(output) or image.width)):
+                width = min(self.get_width(output) or image.width, image.width)
+                if width not in scaled:
+                    source = min((scaled[key] for key in scaled if key > width), key=lambda s: s.width, default=image)
+                    scaled[width] = source if source.width == width else source.resize(
+                        (width, max(1, round(image.height * width / image.width))), Image.Resampling.LANCZOS,
+                        reducing_gap=3.0)
+                futures[output] = executor.submit(self.save, scaled[width], paths[output], *self.get_format(output, paths))
+            if alongside:
+                alongside()
+            return {output: future.result() for output, future in futures.items()}
+
+    def get_format(self, output: str, paths: dict) -> tuple:
+        """Return the (Pillow format, save options) of an output"""
+        if output != 'full':
+            return OUTPUT_FORMATS[output][1:]
+        imageFormat = Image.registered_extensions().get(os.path.splitext(paths[output])[1].lower(), 'PNG')
+        return imageFormat, {'compress_level': self.compressLevel} if imageFormat == 'PNG' else {}
+
+    @staticmethod
+    def save(image: Image, path: str, imageFormat: str, options: dict) -> tuple:
+        """Encode image to path and return (bytes, seconds)"""
+        start = time.perf_counter()
+        image.save(path + '.part', format=imageFormat, **options)
+        os.replace(path + '.part', path)
+        return os.path.getsize(path), time.perf_counter() - start
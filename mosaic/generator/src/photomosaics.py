@@ -1,24 +1,151 @@
 from PIL import Image
-import json, os, sys, random, math
+from featurestore import FeatureStore
+from sharedarrays import SharedArray
+from pyramid import DeepZoomWriter
+from instrumentation import NULL_INSTRUMENTATION
+from tilecache import TileCache
+from rendercache import RenderCache
+from outputs import OutputEncoder
+from multiprocessing import Pool
+from collections import deque
+import numpy as np
+import hashlib, os, sys, random, math, time
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # scipy is optional, best_matches falls back to a brute-force scan
+    cKDTree = None
+
+
+def _init_tile_worker(tileSpec: tuple, averageSpec: tuple):
+    """Attach a tile decoding worker to the shared output arrays (only averages when tileSpec is None)"""
+    global _sharedTiles, _sharedAverages
+    _sharedTiles = SharedArray.attach(tileSpec) if tileSpec else None
+    _sharedAverages = SharedArray.attach(averageSpec)
+
+
+def _decode_tiles(job: tuple) -> int:
+    """Decode a chunk of tiles straight into the shared output arrays"""
+    start, paths, dimension = job
+    for offset, path in enumerate(paths):
+        tile, average = PhotoMosaic.load_tile(path, dimension)
+        if _sharedTiles:
+            _sharedTiles.array[start + offset] = tile
+        _sharedAverages.array[start + offset] = average
+    return len(paths)
+
+
+def _init_render_worker(state: dict):
+    """Rebuild a render-only PhotoMosaic inside a band rendering worker"""
+    global _renderMosaic
+    _renderMosaic = PhotoMosaic.from_render_state(state)
+
+
+def _render_band(band: tuple) -> tuple:
+    """Render one band of rows in a worker, returning its chosen tiles along with its pixels"""
+    y, y2 = band
+    tileIndices = _renderMosaic.match_cells(y, y2)
+    return y, tileIndices, _renderMosaic.paste_tiles(tileIndices, y2 - y)
 
 
 class PhotoMosaic:
-    def __init__(self, imageFile, imagesFolder, step=100, targetWidth=5000):
-        self.folder = os.path.basename(os.path.normpath(imagesFolder))
+    # Receives phase events (durations, counts, cache hits, memory); a no-op unless given sinks
+    instrumentation = NULL_INSTRUMENTATION
+
+    def __init__(self, imageFile, imagesFolder, step=100, targetWidth=5000, matchMode='kdtree',
+                 cacheDir='cache', hashTiles=False, workers=1, seed=None, stream=False, bandHeight=1024,
+                 lutSize=64, instrumentation=None, tileCacheSize=None, renderCache=False, minStep=None,
+                 splitDeviation=24.0):
+        # imagesFolder is either a folder of images or a (tiles, height, width, 3) uint8 array of them
+        self.folder = 'array' if isinstance(imagesFolder, np.ndarray) else os.path.basename(os.path.normpath(imagesFolder))
+        if instrumentation is not None:
+            self.instrumentation = instrumentation
         self.step = step
         self.targetWidth = targetWidth
-        self.imageFile = os.path.basename(imageFile)
-        self.image = self.get_image(imageFile, resize=True)
+        # In streaming mode only the source image is held; the upscaled target and the mosaic
+        # are produced one band at a time by save_image
+        self.stream = stream
+        self.bandHeight = bandHeight
+        self.matchMode = matchMode
+        self.lutSize = lutSize
+        # When set, tile pixels of a folder are decoded only once chosen, keeping at most this many
+        self.tileCacheSize = tileCacheSize
+        self.cacheDir = cacheDir
+        self.hashTiles = hashTiles
+        self.workers = workers
+        # Tile choices are drawn from per-row generators seeded from this, so a fixed seed
+        # gives the same mosaic whatever the number of workers
+        self.seed = seed if seed is not None else np.random.SeedSequence().entropy
+        self.fixedSeed = seed is not None
+        # Keep each render's cell hashes, tiles and pixels in cacheDir so re-rendering the same
+        # target only redoes the cells that changed
+        self.renderCache = renderCache
+        # With minStep set, cells start at step and are split into quarters, down to minStep,
+        # wherever the colours in them vary by more than splitDeviation
+        if minStep is not None:
+            ratio = step // minStep if minStep > 0 else 0
+            if ratio < 1 or step % minStep or ratio & (ratio - 1):
+                raise ValueError(f"step {step} must be minStep {minStep} times a power of two")
+            if stream:
+                raise ValueError("adaptive cells (minStep) can't be rendered in streaming mode")
+        self.minStep = minStep
+        self.splitDeviation = splitDeviation
+        self.imageDictionary, self.tiles = self.load_images(imagesFolder, dimension=(self.step, self.step))
+        self.keys = list(self.imageDictionary.keys())
+        self.keyArray = np.array(self.keys, dtype=np.float64).reshape(-1, 3)
+        with self.instrumentation.phase('build_index', matchMode=matchMode, keys=len(self.keyArray)):
+            self.index = self.build_index()
+        self.lut = self.get_lut() if matchMode == 'lut' else None
+        self.groupTiles, self.groupStarts, self.groupCounts = self.get_groups()
+        self.cellTiles = None
+        # Paths of the files written by the last save_image, by output
+        self.outputPaths = {}
+        # Cell averages each tile of the last animation frame was matched at
+        self.frameAverages = None
+        # Edge tiles resized so far during render_bands, by size and tile index
+        self.edgeTiles = None
+        # Without an imageFile only the library is loaded, ready to render targets given to set_target
+        self.imageFile = self.image = self.source = self.matrix = self.editedImage = None
+        if imageFile is not None:
+            self.set_target(imageFile)
+            self.editedImage = None if stream else self.photo_mosaic()
+
+    def set_target(self, imageFile: str, targetWidth: int = None):
+        """Load the image to turn into a mosaic, optionally at a new target width.
+
+        The tile library and match index are kept, so any number of targets can be rendered
+        with photo_mosaic or save_image after loading it once.
+        """
+        with self.instrumentation.phase('set_target', image=os.path.basename(imageFile)) as phase:
+            if targetWidth is not None:
+                self.targetWidth = targetWidth
+            self.imageFile = os.path.basename(imageFile)
+            self.editedImage = None
+            if self.stream:
+                self.image = self.matrix = None
+                self.source = self.get_image(imageFile)
+                self.width, self.height = self.get_target_size(self.source)
+            else:
+                self.source = None
+                self.image = self.get_image(imageFile, resize=True)
+                self.width, self.height = self.image.size
+                self.matrix = self.get_matrix()
+            phase.update(width=self.width, height=self.height, stream=self.stream)
+
+    def set_frame(self, image: Image, name: str):
+        """Load one frame of an animation as the target, resized to the current target width"""
+        if self.stream:
+            raise ValueError("animation frames can't be rendered in streaming mode")
+        self.imageFile = name
+        self.editedImage = self.source = None
+        self.image = self.resize_image(image.convert('RGB'))
         self.width, self.height = self.image.size
-        self.imageDictionary = self.load_images(imagesFolder, dimension=(self.step, self.step))
-        self.matrix = self.get_matrix()
-        self.editedImage = self.photo_mosaic()
+        self.matrix = np.asarray(self.image, dtype=np.uint8)
 
-    def get_matrix(self) -> list:
-        """Returns a 2D list of RGB tuples of image"""
+    def get_matrix(self) -> np.ndarray:
+        """Returns a (height, width, 3) uint8 array of the image's RGB values"""
         print("Loading matrix...")
-        pixels = list(self.image.getdata())
-        return [pixels[y:y+self.width] for y in range(0, len(pixels), self.width)]
+        return np.asarray(self.image.convert('RGB'), dtype=np.uint8)
 
     def get_image(self, path: str, thumbnail: tuple = None, squareImage: bool = None, resize: bool = None) -> Image:
         """Return an Image object"""
@@ -44,112 +171,646 @@ class PhotoMosaic:
 
     def resize_image(self, image: Image) -> Image:
         """Resize image to a bigger size so sub-images are more visible"""
+        return image.resize(self.get_target_size(image), Image.Resampling.LANCZOS)
+
+    def get_target_size(self, image: Image) -> tuple:
+        """Return the (width, height) image is resized to, keeping its aspect ratio at targetWidth"""
         width, height = image.size
         baseWidth = self.targetWidth
         widthPercent = baseWidth / width
         newHeight = int(height * widthPercent)
-        return image.resize((baseWidth, newHeight), Image.Resampling.LANCZOS)
+        return baseWidth, newHeight
 
-    @staticmethod
-    def get_cache(cacheFile) -> dict:
-        """Return a cached dictionary from json file if exists"""
-        try:
-            with open(cacheFile, 'r') as jsonFile:
-                return json.load(jsonFile)
-        except FileNotFoundError:
-            return {}
+    def get_target_band(self, y: int, y2: int) -> np.ndarray:
+        """Return rows y to y2 of the resized target as a uint8 RGB array.
 
-    @staticmethod
-    def store_cache(cacheFile, cachedInfo):
-        """Store average of images' RGB values as cache for future use"""
-        with open(cacheFile, 'w') as jsonFile:
-            json.dump(cachedInfo, jsonFile, indent=4, sort_keys=True)
-
-    def load_images(self, folderPath: str, dimension: tuple) -> dict:
-        """Load all images in given path and return dictionary containing them"""
-        print("Loading images...")
-        previous_path = os.getcwd()
-        os.chdir(folderPath)
-        cacheUpdated = False
-        cacheFile = '_'.join(self.folder.lower().split()) + '_cache.json'
-        cachedInfo = self.get_cache(cacheFile)
-        imagesDictionary = {}
-
-        for file in os.listdir():
-            if not file.lower().endswith(('.png', '.jpg', '.jpeg')):
-                continue
-            # Load image and resize to the actual tile size we'll use
-            image = self.get_image(file, thumbnail=dimension, squareImage=True)
-            if file in cachedInfo.keys():
-                average = tuple(cachedInfo[file])
+        In streaming mode only that band is resized from the source image; resizing a box of
+        the source matches slicing the fully resized image up to rounding of single values.
+        """
+        if self.matrix is not None:
+            return self.matrix[y:y2]
+        sourceWidth, sourceHeight = self.source.size
+        scale = sourceHeight / self.height
+        band = self.source.resize((self.width, y2 - y), Image.Resampling.LANCZOS,
+                                  box=(0, y * scale, sourceWidth, y2 * scale))
+        return np.asarray(band.convert('RGB'), dtype=np.uint8)
+
+    def load_images(self, folderPath, dimension: tuple) -> tuple:
+        """Load all images in given path, or given (tiles, height, width, 3) uint8 array.
+
+        Returns a dictionary mapping each average RGB tuple to the indices of its tiles, and a
+        (tiles, height, width, 3) uint8 array with every tile resized to dimension. For a folder
+        both come from the feature store when the files haven't changed, so only new or modified
+        images are decoded, and the tiles are memory-mapped from the store's file. With
+        tileCacheSize set, only averages are loaded for a folder and the tiles are a TileCache
+        decoding them on demand, so memory grows with the tiles used rather than with the library.
+        """
+        with self.instrumentation.phase('load_images', source=self.folder, step=dimension[0]) as phase:
+            print("Loading images...")
+            if isinstance(folderPath, np.ndarray):
+                tiles, averages = self.load_array_tiles(folderPath, dimension)
+                print(f"Loaded {len(tiles)} images from an array.")
+                phase.update(tiles=len(tiles))
             else:
-                pixels = list(image.getdata())
-                average = self.get_average(pixels)
-                cachedInfo[file] = average
-                cacheUpdated = True
-            if average not in imagesDictionary:
-                imagesDictionary[average] = [image]
+                store = FeatureStore(folderPath, self.cacheDir, self.hashTiles)
+                names = store.update()
+                averageName, tileName = f'mean@{dimension[0]}x{dimension[1]}', f'tiles@{dimension[0]}x{dimension[1]}'
+                paths = [os.path.join(folderPath, name) for name in names]
+                lazy = self.tileCacheSize is not None
+                missing = store.get_mask(averageName) if lazy else store.get_mask(averageName) & store.get_mask(tileName)
+                missing = np.flatnonzero(~missing)
+                if len(missing):
+                    tiles, averages = self.decode_tiles([paths[row] for row in missing], dimension, keepTiles=not lazy)
+                    store.put(averageName, missing, averages)
+                    if not lazy:
+                        store.put(tileName, missing, tiles)
+                store.save()
+                print(f"Loaded {len(names)} images, {len(names) - len(missing)} from cache.")
+                phase.update(tiles=len(names), cacheHits=len(names) - len(missing), cacheMisses=len(missing))
+                averages, _ = store.get(averageName)
+                if lazy:
+                    tiles = TileCache(paths, dimension, PhotoMosaic.load_tile, self.tileCacheSize)
+                else:
+                    tiles, _ = store.get(tileName)
+                store.close()
+
+            imagesDictionary = {}
+            for row, average in enumerate(map(tuple, averages.tolist())):
+                if average not in imagesDictionary:
+                    imagesDictionary[average] = [row]
+                else:
+                    imagesDictionary[average].append(row)
+            return imagesDictionary, tiles
+
+    def load_array_tiles(self, images: np.ndarray, dimension: tuple) -> tuple:
+        """Return (tiles, averages) of a (tiles, height, width, 3) uint8 array, which may be memory-mapped.
+
+        Images already of size dimension are used as they are, with no copy; others are
+        cropped and resized one by one like image files.
+        """
+        if images.shape[1:3] == (dimension[1], dimension[0]):
+            averages = np.empty((len(images), 3), dtype=np.float64)
+            for start in range(0, len(images), 4096):
+                averages[start:start + 4096] = images[start:start + 4096, :, :, :3].mean(axis=(1, 2), dtype=np.float64)
+            return images, averages
+        tiles = np.empty((len(images), dimension[1], dimension[0], 3), dtype=np.uint8)
+        averages = np.empty((len(images), 3), dtype=np.float64)
+        for row, image in enumerate(images):
+            tiles[row], averages[row] = self.prepare_tile(Image.fromarray(image), dimension)
+        return tiles, averages
+
+    def decode_tiles(self, paths: list, dimension: tuple, keepTiles: bool = True) -> tuple:
+        """Return (tiles, averages) of the given image files, decoded by a pool of self.workers processes.
+
+        Workers write into shared memory, so no image data is pickled between processes. When
+        keepTiles is False only the averages are kept and tiles is None.
+        """
+        with self.instrumentation.phase('decode_tiles', images=len(paths), workers=self.workers):
+            start = time.perf_counter()
+            tiles = np.empty((len(paths), dimension[1], dimension[0], 3), dtype=np.uint8) if keepTiles else None
+            averages = np.empty((len(paths), 3), dtype=np.float64)
+            if self.workers <= 1 or len(paths) < 2 * self.workers:
+                for row, path in enumerate(paths):
+                    tile, averages[row] = self.load_tile(path, dimension)
+                    if keepTiles:
+                        tiles[row] = tile
             else:
-                imagesDictionary[average].append(image)
+                sharedTiles = SharedArray(tiles.shape, tiles.dtype) if keepTiles else None
+                sharedAverages = SharedArray(averages.shape, averages.dtype)
+                chunk = max(1, min(256, len(paths) // (4 * self.workers)))
+                jobs = [(row, paths[row:row + chunk], dimension) for row in range(0, len(paths), chunk)]
+                try:
+                    with Pool(self.workers, _init_tile_worker,
+                              (sharedTiles.spec if keepTiles else None, sharedAverages.spec)) as pool:
+                        for _ in pool.imap_unordered(_decode_tiles, jobs):
+                            pass
+                    averages[...] = sharedAverages.array
+                    if keepTiles:
+                        tiles[...] = sharedTiles.array
+                finally:
+                    if keepTiles:
+                        sharedTiles.unlink()
+                    sharedAverages.unlink()
+            elapsed = time.perf_counter() - start
+            print(f"Decoded {len(paths)} images in {elapsed:.1f}s ({len(paths) / max(elapsed, 1e-9):.0f} images/sec).")
+            return tiles, averages
+
+    @staticmethod
+    def load_tile(path: str, dimension: tuple) -> tuple:
+        """Return (tile, average) of an image file: a center-cropped, dimension-sized RGB uint8 array and its average RGB.
+
+        JPEGs are decoded in draft mode, at the smallest DCT scale that still covers dimension.
+        """
+        with Image.open(path) as image:
+            width, height = image.size
+            scale = max(dimension) / min(width, height)
+            image.draft('RGB', (math.ceil(width * scale), math.ceil(height * scale)))
+            return PhotoMosaic.prepare_tile(image, dimension)
+
+    @staticmethod
+    def prepare_tile(image: Image, dimension: tuple) -> tuple:
+        """Return (tile, average) of an image: center-cropped to a square, thumbnailed and resized to dimension"""
+        width, height = image.size
+        if width != height:
+            toCrop = min((width, height))
+            image = PhotoMosaic.crop_center(image, toCrop, toCrop)
+        image.thumbnail(dimension)
+        image = image.convert('RGB')
+        return PhotoMosaic.get_tile(image, dimension), PhotoMosaic.get_average(np.asarray(image))
+
+    @staticmethod
+    def get_tile(image: Image, dimension: tuple) -> np.ndarray:
+        """Return a thumbnailed image as a dimension-sized RGB uint8 array"""
+        if image.size != dimension:
+            image = image.resize(dimension, Image.Resampling.LANCZOS)
+        return np.asarray(image.convert('RGB'), dtype=np.uint8)
+
+    def get_groups(self) -> tuple:
+        """Return tile indices grouped by key, with each key's start offset and tile count"""
+        groupCounts = np.array([len(self.imageDictionary[key]) for key in self.keys], dtype=np.intp)
+        groupStarts = np.cumsum(groupCounts) - groupCounts
+        groupTiles = np.concatenate([self.imageDictionary[key] for key in self.keys]).astype(np.intp)
+        return groupTiles, groupStarts, groupCounts
+
+    def build_index(self):
+        """Return a KD-tree over the tile averages, or None when matching by brute force.
+
+        The KD-tree is also used to fill the lookup table in 'lut' mode.
+        """
+        if self.matchMode == 'brute':
+            return None
+        if cKDTree is None:
+            print("scipy is not installed, falling back to brute-force matching.")
+            return None
+        return cKDTree(self.keyArray)
+
+    def best_matches(self, averages: np.ndarray) -> np.ndarray:
+        """Return the index into self.keys of the nearest tile average for every row of averages.
+
+        In 'lut' mode this is a single lookup of each average's cell in the quantized RGB cube.
+        """
+        averages = np.asarray(averages, dtype=np.float64).reshape(-1, 3)
+        if self.lut is not None:
+            cells = np.clip((averages * (self.lutSize / 256)).astype(np.intp), 0, self.lutSize - 1)
+            return self.lut[cells[:, 0], cells[:, 1], cells[:, 2]]
+        return self.nearest_keys(averages)
 
-        if cacheUpdated:
-            self.store_cache(cacheFile, cachedInfo)
+    def nearest_keys(self, averages: np.ndarray) -> np.ndarray:
+        """Return the index into self.keys of the exact nearest tile average for every row of averages"""
+        if self.index is not None:
+            _, keyIndices = self.index.query(averages)
+            return keyIndices
+        # Brute-force reference: exact euclidean distances, chunked so memory stays bounded
+        keyIndices = np.empty(len(averages), dtype=np.intp)
+        chunk = max(1, 2 ** 22 // len(self.keyArray))
+        for start in range(0, len(averages), chunk):
+            differences = averages[start:start + chunk, None, :] - self.keyArray[None, :, :]
+            keyIndices[start:start + chunk] = (differences ** 2).sum(axis=2).argmin(axis=1)
+        return keyIndices
 
-        os.chdir(previous_path)
-        return imagesDictionary
+    def get_lut(self) -> np.ndarray:
+        """Return a (lutSize, lutSize, lutSize) lookup table of the nearest key to the center of each cell of the RGB cube.
+
+        Tables are saved in cacheDir, named after a hash of the tile averages, so they are only
+        computed once per library and size.
+        """
+        with self.instrumentation.phase('get_lut', lutSize=self.lutSize) as phase:
+            libraryHash = hashlib.sha1(self.keyArray.tobytes()).hexdigest()[:16]
+            path = os.path.join(self.cacheDir, f"lut{self.lutSize}-{libraryHash}.npy")
+            try:
+                lut = np.load(path)
+                phase.update(cacheHit=True)
+                return lut
+            except (FileNotFoundError, ValueError):
+                phase.update(cacheHit=False)
+            print(f"Building {self.lutSize}x{self.lutSize}x{self.lutSize} lookup table...")
+            centers = (np.arange(self.lutSize) + 0.5) * (256 / self.lutSize)
+            cube = np.stack(np.meshgrid(centers, centers, centers, indexing='ij'), axis=-1).reshape(-1, 3)
+            lut = self.nearest_keys(cube).astype(np.int32).reshape(self.lutSize, self.lutSize, self.lutSize)
+            os.makedirs(self.cacheDir, exist_ok=True)
+            np.save(path, lut)
+            return lut
+
+    def lut_error(self) -> dict:
+        """Return how lookup table matches of this target's cells compare with exact matching.
+
+        Reports the fraction of cells matched to a different tile average, and the mean and
+        maximum extra euclidean distance to the matched average that this costs.
+        """
+        mismatched, extra, maxExtra, cells = 0, 0.0, 0.0, 0
+        for y, y2 in self.get_bands():
+            averages = self.get_cell_averages(self.get_target_band(y, y2), self.step).reshape(-1, 3)
+            exact, approximate = self.nearest_keys(averages), self.best_matches(averages)
+            distances = np.linalg.norm(averages - self.keyArray[approximate], axis=1) - \
+                np.linalg.norm(averages - self.keyArray[exact], axis=1)
+            mismatched += int((exact != approximate).sum())
+            extra += float(distances.sum())
+            maxExtra = max(maxExtra, float(distances.max()))
+            cells += len(averages)
+        return {'cells': cells, 'mismatched': mismatched / cells, 'meanExtraDistance': extra / cells,
+                'maxExtraDistance': maxExtra}
 
     def best_match(self, rgbTuple: tuple) -> Image:
         """Return best possible image from imageDict that matches rgbTuple based on euclidean distance"""
-        bestKeys = []
-        bestDistance = None
-        for otherTuple in self.imageDictionary.keys():
-            currentDistance = self.euclidean_distance(rgbTuple, otherTuple)
-            if not bestDistance or currentDistance < bestDistance:
-                bestDistance = currentDistance
-                bestKeys.insert(0, otherTuple)
-        key = bestKeys[0]
-        return random.choice(self.imageDictionary[key])
+        key = self.keys[self.best_matches(rgbTuple)[0]]
+        return Image.fromarray(self.tiles[random.choice(self.imageDictionary[key])])
+
+    def choose_tiles(self, keyIndices: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+        """Return a tile index for every key index, picked at random among the tiles sharing that key"""
+        counts = self.groupCounts[keyIndices]
+        offsets = (rng.random(counts.shape) * counts).astype(np.intp)
+        return self.groupTiles[self.groupStarts[keyIndices] + offsets]
+
+    def get_atlas(self, size: tuple, tileIndices: np.ndarray) -> tuple:
+        """Return (atlas, atlasTiles): the given tiles resized once to size (width, height) and
+        stacked contiguously, along with the sorted tile indices of its entries.
+
+        Full step x step cells use self.tiles directly, in which case atlasTiles is None, unless
+        tiles are decoded on demand. Resized tiles are kept in self.edgeTiles while it is set, so
+        the edge cells of every band reuse them.
+        """
+        lazy = isinstance(self.tiles, TileCache)
+        if size == (self.step, self.step) and not lazy:
+            return self.tiles, None
+        atlasTiles = np.unique(tileIndices)
+        if size == (self.step, self.step):
+            return self.tiles[atlasTiles], atlasTiles
+        atlas = np.empty((len(atlasTiles), size[1], size[0], 3), dtype=np.uint8)
+        resized = self.edgeTiles.setdefault(size, {}) if self.edgeTiles is not None else {}
+        for position, tile in enumerate(atlasTiles):
+            if tile not in resized:
+                resized[tile] = np.asarray(Image.fromarray(self.tiles[tile]).resize(size, Image.Resampling.LANCZOS))
+            atlas[position] = resized[tile]
+        return atlas, atlasTiles
 
     def photo_mosaic(self) -> Image:
-        """Return a manipulated image with mosaic implemented"""
-        print("Creating a mosaic...")
-        editedImage = Image.new(self.image.mode, (self.width, self.height))
-        for y in range(0, self.height, self.step):
-            y2 = y + self.step if y + self.step < self.height else self.height
-            for x in range(0, self.width, self.step):
-                x2 = x + self.step if x + self.step < self.width else self.width
-                subMatrix = []
-                for z in range(y, y2):
-                    subList = self.matrix[z][x:x2]
-                    subMatrix.append(subList)
-                flat_list = [rgbTuple for row in subMatrix for rgbTuple in row]
-                average = self.get_average(flat_list)
-                img = self.best_match(average)
-                # Ensure the image is resized to match the step size
-                img_resized = img.resize((x2-x, y2-y), Image.Resampling.LANCZOS)
-                editedImage.paste(img_resized, (x, y))
-            self.progress_bar(y, self.height)
-        print()
-        return editedImage
-
-    def save_image(self):
-        """Save image to a folder"""
-        folderName = "out"
-        previous_path = os.getcwd()
-        if not os.path.exists(folderName):
-            os.mkdir(folderName)
-        os.chdir(folderName)
-        name, ext = self.imageFile.split('.')
-        counter = 0
-        output_image = f"{name}-mosaic.{ext}"
-        if os.path.exists(output_image):
-            while os.path.exists(output_image):
-                output_image = f"{name}-mosaic{counter}.{ext}"
-                counter += 1
-        path = os.path.join(os.getcwd(), output_image)
-        self.editedImage.save(path)
-        print(f"Photo mosaic has been successfully saved to {path}.")
-        os.chdir(previous_path)
+        """Return a manipulated image with mosaic implemented.
+
+        With renderCache set, a previous render of the same target, size, step and library is
+        reused and only the cells whose pixels changed since are matched and pasted again. With
+        minStep set, the mosaic is made of adaptive quadtree cells instead (not render cached).
+        """
+        with self.instrumentation.phase('render', **self.get_render_fields()) as phase:
+            print("Creating a mosaic...")
+            if self.minStep is not None:
+                return Image.fromarray(self.render_adaptive(phase))
+            hashes = self.get_cell_hashes(self.matrix, self.step) if self.renderCache else None
+            cache = RenderCache(self.cacheDir, self.get_render_key()) if self.renderCache else None
+            previous = cache.load() if cache else None
+            if previous is not None and previous[0].shape == hashes.shape and (not self.fixedSeed or previous[2] == self.seed):
+                previousHashes, previousTiles, self.seed, previousMosaic = previous
+                editedMatrix = np.array(previousMosaic)
+                del previous, previousMosaic
+                changed = hashes != previousHashes
+                print(f"Reusing the previous render, {int(changed.sum())} of {changed.size} cells changed.")
+                self.update_cells(editedMatrix, changed, previousTiles)
+                changedRows = [(row * self.step, (row + 1) * self.step) for row in np.flatnonzero(changed.any(axis=1))]
+                phase.update(changedCells=int(changed.sum()))
+            else:
+                changedRows = None
+                editedMatrix = np.empty((self.height, self.width, 3), dtype=np.uint8)
+                for y, band in self.render_bands():
+                    editedMatrix[y:y + len(band)] = band
+                    self.progress_bar(y + len(band), self.height)
+                print()
+            if cache:
+                cache.save(hashes, self.cellTiles, self.seed, editedMatrix, changedRows)
+            phase.update(self.get_tile_cache_fields())
+            return Image.fromarray(editedMatrix)
+
+    def render_frame(self, previousMatrix: np.ndarray = None, threshold: float = 4.0, frame: int = 0) -> tuple:
+        """Return (mosaic, changed cells) of the target loaded by set_frame, as the next frame of an animation.
+
+        Cells whose average colour is within threshold of the average their tile was matched at
+        keep that tile, so they don't flicker between equally good tiles and aren't matched or
+        pasted again: previousMatrix, the mosaic of the previous frame, is updated in place. The
+        first frame, or one without previousMatrix, is matched in full.
+        """
+        if self.minStep is not None:
+            raise ValueError("animation frames can't be rendered with adaptive cells (minStep)")
+        with self.instrumentation.phase('render_frame', frame=frame, **self.get_render_fields()) as phase:
+            averages = self.get_cell_averages(self.matrix, self.step)
+            if previousMatrix is None or self.frameAverages is None or self.frameAverages.shape != averages.shape:
+                changed = np.ones(averages.shape[:2], dtype=bool)
+                editedMatrix = np.empty((self.height, self.width, 3), dtype=np.uint8)
+                self.frameAverages = averages
+                self.cellTiles = np.empty(averages.shape[:2], dtype=np.intp)
+            else:
+                changed = ((averages - self.frameAverages) ** 2).sum(axis=2) > threshold ** 2
+                editedMatrix = previousMatrix
+                self.frameAverages[changed] = averages[changed]
+            if changed.any():
+                rng = np.random.default_rng([self.seed, frame])
+                self.cellTiles[changed] = self.choose_tiles(self.best_matches(averages[changed]), rng)
+                self.paste_cells(editedMatrix, changed)
+            phase.update(changedCells=int(changed.sum()), **self.get_tile_cache_fields())
+            return editedMatrix, int(changed.sum())
+
+    def get_quadtree_cells(self) -> list:
+        """Return the cells of an adaptive mosaic as (size, ys, xs, averages), one entry per cell size from step to minStep.
+
+        Cells start on the step grid and are split into quarters while they are larger than
+        minStep and the RMS distance of their pixels from their average colour is above
+        splitDeviation. The mean and variance of any cell take four lookups in a summed-area
+        table of the target, and are computed for all the cells of a size at once.
+        """
+        table = self.get_summed_area_table(self.matrix, self.minStep)
+        cells = []
+        size = self.step
+        active = np.ones((math.ceil(self.height / size), math.ceil(self.width / size)), dtype=bool)
+        while True:
+            span = size // self.minStep
+            rows = np.minimum(np.arange(active.shape[0] + 1) * span, table.shape[0] - 1)
+            cols = np.minimum(np.arange(active.shape[1] + 1) * span, table.shape[1] - 1)
+            sums = (table[rows[1:]][:, cols[1:]] - table[rows[:-1]][:, cols[1:]]
+                    - table[rows[1:]][:, cols[:-1]] + table[rows[:-1]][:, cols[:-1]])
+            averages = sums[..., :3] / sums[..., 4:]
+            variances = sums[..., 3] / sums[..., 4] - (averages ** 2).sum(axis=2)
+            split = active & (variances > self.splitDeviation ** 2) if size > self.minStep else np.zeros_like(active)
+            leaves = active & ~split
+            ys, xs = np.nonzero(leaves)
+            cells.append((size, ys * size, xs * size, averages[leaves]))
+            if not split.any():
+                return cells
+            size //= 2
+            active = split.repeat(2, axis=0).repeat(2, axis=1)[:math.ceil(self.height / size),
+                                                                :math.ceil(self.width / size)]
+
+    def render_adaptive(self, phase) -> np.ndarray:
+        """Return the (height, width, 3) uint8 mosaic of the quadtree cells of get_quadtree_cells.
+
+        Every cell is matched in one go. Cells of each size (clipped at the right and bottom
+        edges) get their tiles from one atlas, resized once to that size.
+        """
+        cells = self.get_quadtree_cells()
+        averages = np.concatenate([cellAverages for *_, cellAverages in cells])
+        tileIndices = self.choose_tiles(self.best_matches(averages), np.random.default_rng(self.seed))
+        self.cellTiles = None
+        editedMatrix = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        start = 0
+        for size, ys, xs, _ in cells:
+            tiles = tileIndices[start:start + len(ys)]
+            start += len(ys)
+            heights, widths = np.minimum(size, self.height - ys), np.minimum(size, self.width - xs)
+            for height, width in sorted(set(zip(heights.tolist(), widths.tolist()))):
+                selected = (heights == height) & (widths == width)
+                atlas, atlasTiles = self.get_atlas((width, height), tiles[selected])
+                positions = tiles[selected] if atlasTiles is None else np.searchsorted(atlasTiles, tiles[selected])
+                for y, x, position in zip(ys[selected], xs[selected], positions):
+                    editedMatrix[y:y + height, x:x + width] = atlas[position]
+        sizes = {size: len(ys) for size, ys, *_ in cells}
+        uniform = math.ceil(self.width / self.minStep) * math.ceil(self.height / self.minStep)
+        print(f"Matched {len(averages)} adaptive cells ("
+              + ", ".join(f"{count} of {size}px" for size, count in sizes.items())
+              + f") instead of {uniform} cells of {self.minStep}px.")
+        phase.update(cells=len(averages), cellSizes=sizes, **self.get_tile_cache_fields())
+        return editedMatrix
+
+    def get_render_key(self) -> str:
+        """Return the key a render is cached under: the target's name and size, the step and matching, and the library.
+
+        The library is identified by its tile averages and which tiles share each of them.
+        """
+        digest = hashlib.sha1(f"{self.imageFile}|{self.width}x{self.height}|{self.step}|{self.matchMode}|"
+                              f"{self.lutSize}".encode())
+        digest.update(self.keyArray.tobytes())
+        digest.update(self.groupTiles.tobytes())
+        return digest.hexdigest()[:16]
+
+    def update_cells(self, editedMatrix: np.ndarray, changed: np.ndarray, previousTiles: np.ndarray):
+        """Match and paste again the changed cells of a previous render, taking its tiles for every other cell.
+
+        Rows are redrawn from the same per-row generators, so unchanged cells keep their tile and
+        the result is the same as a full render with that seed.
+        """
+        tileKeys = np.empty(len(self.tiles), dtype=np.intp)
+        tileKeys[self.groupTiles] = np.repeat(np.arange(len(self.keys)), self.groupCounts)
+        self.cellTiles = previousTiles.copy()
+        for row in np.flatnonzero(changed.any(axis=1)):
+            y = row * self.step
+            columns = np.flatnonzero(changed[row])
+            averages = self.get_cell_averages(self.matrix[y:y + self.step], self.step)[0]
+            keyIndices = tileKeys[previousTiles[row]]
+            keyIndices[columns] = self.best_matches(averages[columns])
+            self.cellTiles[row] = self.choose_tiles(keyIndices, np.random.default_rng([self.seed, row]))
+        self.paste_cells(editedMatrix, changed)
+
+    def paste_cells(self, editedMatrix: np.ndarray, cells: np.ndarray):
+        """Paste the tiles of self.cellTiles into the cells of editedMatrix marked in the (rows, cols) mask cells"""
+        rowHeights = np.minimum(self.step, self.height - np.arange(0, self.height, self.step))
+        colWidths = np.minimum(self.step, self.width - np.arange(0, self.width, self.step))
+        for height in np.unique(rowHeights):
+            for width in np.unique(colWidths):
+                selected = cells & (rowHeights[:, None] == height) & (colWidths[None, :] == width)
+                if not selected.any():
+                    continue
+                atlas, atlasTiles = self.get_atlas((int(width), int(height)), self.cellTiles[selected])
+                for row, col in zip(*np.nonzero(selected)):
+                    tile = self.cellTiles[row, col]
+                    position = tile if atlasTiles is None else np.searchsorted(atlasTiles, tile)
+                    y, x = row * self.step, col * self.step
+                    editedMatrix[y:y + height, x:x + width] = atlas[position]
+
+    def get_render_fields(self) -> dict:
+        """Return the size of the render, reported with its instrumentation phase"""
+        return {'width': self.width, 'height': self.height, 'step': self.step, 'workers': self.workers,
+                'cells': math.ceil(self.width / self.step) * math.ceil(self.height / self.step),
+                'bands': len(self.get_bands()), 'stream': self.stream}
+
+    def get_tile_cache_fields(self) -> dict:
+        """Return the hits and misses of tiles decoded on demand in this process, reported with the render phase"""
+        if not isinstance(self.tiles, TileCache):
+            return {}
+        return {'tileCacheHits': self.tiles.hits, 'tileCacheMisses': self.tiles.misses}
+
+    def get_bands(self) -> list:
+        """Return (y, y2) of the horizontal bands rendered as one unit of work, a whole number of cell rows each"""
+        bandHeight = max(1, self.bandHeight // self.step) * self.step
+        return [(y, min(y + bandHeight, self.height)) for y in range(0, self.height, bandHeight)]
+
+    def render_bands(self):
+        """Yield (y, band) for every band, in order, rendered by a pool of self.workers processes.
+
+        Workers share the tiles and target (or source, when streaming) through shared memory and
+        rebuild the match index once. Tiles memory-mapped from a .npy file, such as those of the
+        feature store, are mapped again by every worker instead, with no copy. At most two bands
+        per worker are in flight, so memory stays bounded by the band height. Edge tiles are resized
+        once per render (per worker), not once per band.
+        """
+        bands = self.get_bands()
+        # The tile chosen for every cell is kept, for the render cache
+        self.cellTiles = np.empty((math.ceil(self.height / self.step), math.ceil(self.width / self.step)), dtype=np.intp)
+        if self.workers <= 1 or len(bands) < 2:
+            self.edgeTiles = {}
+            try:
+                for y, y2 in bands:
+                    tileIndices = self.match_cells(y, y2)
+                    yield self.collect_band(y, tileIndices, self.paste_tiles(tileIndices, y2 - y))
+            finally:
+                self.edgeTiles = None
+            return
+        # Tiles decoded on demand are not shared; every worker decodes into a cache of its own
+        tileFile = self.get_mapped_file(self.tiles)
+        sharedTiles = SharedArray.from_array(self.tiles) if isinstance(self.tiles, np.ndarray) and not tileFile else None
+        sharedTarget = SharedArray.from_array(self.matrix if self.matrix is not None else np.asarray(self.source))
+        try:
+            state = self.get_render_state(sharedTiles.spec if sharedTiles else tileFile, sharedTarget.spec)
+            with Pool(min(self.workers, len(bands)), _init_render_worker, (state,)) as pool:
+                pending = deque()
+                for band in bands:
+                    pending.append(pool.apply_async(_render_band, (band,)))
+                    if len(pending) >= 2 * self.workers:
+                        yield self.collect_band(*pending.popleft().get())
+                while pending:
+                    yield self.collect_band(*pending.popleft().get())
+        finally:
+            if sharedTiles:
+                sharedTiles.unlink()
+            sharedTarget.unlink()
+
+    def collect_band(self, y: int, tileIndices: np.ndarray, band: np.ndarray) -> tuple:
+        """Record the tiles chosen for a rendered band and return (y, band)"""
+        self.cellTiles[y // self.step:y // self.step + len(tileIndices)] = tileIndices
+        return y, band
+
+    @staticmethod
+    def get_mapped_file(array) -> str:
+        """Return the path of the .npy file array is a memory-mapped view of as a whole, or None"""
+        if not isinstance(array, np.memmap) or not array.filename or not array.filename.endswith('.npy'):
+            return None
+        try:
+            return array.filename if np.load(array.filename, mmap_mode='r').shape == array.shape else None
+        except (OSError, ValueError):
+            return None
+
+    def get_render_state(self, tileSpec, targetSpec: tuple) -> dict:
+        """Return the picklable state a band rendering worker needs; tileSpec is a shared array spec or a .npy path"""
+        return {'step': self.step, 'width': self.width, 'height': self.height, 'seed': self.seed,
+                'matchMode': self.matchMode, 'keyArray': self.keyArray, 'lutSize': self.lutSize, 'lut': self.lut,
+                'groupTiles': self.groupTiles, 'groupStarts': self.groupStarts, 'groupCounts': self.groupCounts,
+                'stream': self.stream, 'tileSpec': tileSpec, 'targetSpec': targetSpec,
+                'tileCache': None if tileSpec else self.tiles}
+
+    @classmethod
+    def from_render_state(cls, state: dict) -> 'PhotoMosaic':
+        """Return a PhotoMosaic that can only render bands, built from get_render_state in another process"""
+        mosaic = cls.__new__(cls)
+        for name in ('step', 'width', 'height', 'seed', 'matchMode', 'keyArray', 'lutSize', 'lut', 'groupTiles',
+                     'groupStarts', 'groupCounts', 'stream'):
+            setattr(mosaic, name, state[name])
+        mosaic.sharedTarget = SharedArray.attach(state['targetSpec'])
+        if isinstance(state['tileSpec'], str):
+            mosaic.tiles = np.load(state['tileSpec'], mmap_mode='r')
+        elif state['tileSpec']:
+            mosaic.sharedTiles = SharedArray.attach(state['tileSpec'])
+            mosaic.tiles = mosaic.sharedTiles.array
+        else:
+            mosaic.tiles = state['tileCache']
+        if mosaic.stream:
+            mosaic.matrix, mosaic.source = None, Image.fromarray(mosaic.sharedTarget.array)
+        else:
+            mosaic.matrix, mosaic.source = mosaic.sharedTarget.array, None
+        mosaic.index = mosaic.build_index()
+        # The worker pool lasts for one render, and so do its resized edge tiles
+        mosaic.edgeTiles = {}
+        return mosaic
+
+    def render_band(self, y: int, y2: int) -> np.ndarray:
+        """Return the (y2 - y, width, 3) uint8 mosaic of rows y to y2, where y is a multiple of step"""
+        return self.paste_tiles(self.match_cells(y, y2), y2 - y)
+
+    def match_cells(self, y: int, y2: int) -> np.ndarray:
+        """Return the (rows, cols) indices of the tiles chosen for the cells of rows y to y2, where y is a multiple of step"""
+        averages = self.get_cell_averages(self.get_target_band(y, y2), self.step)
+        keyIndices = self.best_matches(averages).reshape(averages.shape[:2])
+        firstRow = y // self.step
+        return np.stack([self.choose_tiles(keyIndices[row], np.random.default_rng([self.seed, firstRow + row]))
+                         for row in range(len(keyIndices))])
+
+    def paste_tiles(self, tileIndices: np.ndarray, height: int) -> np.ndarray:
+        """Return a (height, width, 3) uint8 array with the given (rows, cols) tiles laid out on the step grid"""
+        rowHeights = np.minimum(self.step, height - np.arange(0, height, self.step))
+        fullCols = self.width // self.step
+        columnGroups = [(colStart, colEnd) for colStart, colEnd in ((0, fullCols), (fullCols, tileIndices.shape[1]))
+                        if colStart < colEnd]
+        editedMatrix = np.empty((height, self.width, 3), dtype=np.uint8)
+        atlases = {}
+        for row, y in enumerate(range(0, height, self.step)):
+            y2 = y + self.step if y + self.step < height else height
+            for colStart, colEnd in columnGroups:
+                x = colStart * self.step
+                x2 = colEnd * self.step if colEnd * self.step < self.width else self.width
+                size = ((x2 - x) // (colEnd - colStart), y2 - y)
+                if size not in atlases:
+                    # Every cell with this size gets its tile from the same atlas, resized only once
+                    atlases[size] = self.get_atlas(size, tileIndices[rowHeights == size[1], colStart:colEnd])
+                atlas, atlasTiles = atlases[size]
+                positions = tileIndices[row, colStart:colEnd]
+                if atlasTiles is not None:
+                    positions = np.searchsorted(atlasTiles, positions)
+                blocks = atlas[positions]
+                editedMatrix[y:y2, x:x2] = blocks.transpose(1, 0, 2, 3).reshape(y2 - y, x2 - x, 3)
+        return editedMatrix
+
+    def save_image(self, pyramid: bool = False, tileSize: int = 254, folderName: str = "out",
+                   encoder: OutputEncoder = None) -> str:
+        """Save image to a folder, along with a Deep Zoom tile pyramid of it if pyramid is set, and return its path.
+
+        encoder chooses the files written, by default only the mosaic at full size in the
+        target's format; they are encoded in parallel, alongside the pyramid. In streaming mode
+        the mosaic is rendered band by band straight into a binary PPM file (and the pyramid),
+        so it is never held in memory as a whole, and no downscaled outputs are made; encoder
+        must then include 'full', or ValueError is raised.
+        """
+        encoder = encoder or OutputEncoder()
+        if self.stream and 'full' not in encoder.outputs:
+            raise ValueError("streaming mode only writes the full-size mosaic, so outputs must include 'full'")
+        with self.instrumentation.phase('save_image', pyramid=pyramid, outputs=list(encoder.outputs)) as phase:
+            os.makedirs(folderName, exist_ok=True)
+            name, ext = os.path.splitext(self.imageFile)
+            paths = encoder.get_paths(folderName, name, 'ppm' if self.stream else ext[1:], self.width)
+            path = paths.get('full', next(iter(paths.values())))
+            writer = DeepZoomWriter(os.path.splitext(path)[0], self.width, self.height, tileSize) if pyramid else None
+            if self.stream:
+                self.write_ppm(path, writer)
+                skipped = [output for output in paths if output != 'full']
+                if skipped:
+                    print(f"Skipping {', '.join(skipped)} in streaming mode.")
+                paths = {output: paths[output] for output in paths if output == 'full'}
+            else:
+                sizes = encoder.encode(self.editedImage, paths,
+                                       alongside=(lambda: self.write_pyramid(writer)) if writer else None)
+                for output, (size, seconds) in sizes.items():
+                    print(f"Encoded {output} ({size / 1e6:.2f} MB) in {seconds:.2f} s.")
+                phase.update(outputBytes={output: size for output, (size, _) in sizes.items()})
+            for outputPath in paths.values():
+                print(f"Photo mosaic has been successfully saved to {outputPath}.")
+            if writer:
+                writer.close()
+                print(f"Deep zoom pyramid has been successfully saved to {writer.path}.dzi.")
+            self.outputPaths = paths
+            phase.update(path=path)
+            return path
+
+    def write_ppm(self, path: str, writer: DeepZoomWriter = None):
+        """Render the mosaic band by band into a binary PPM file at path, and into writer if given"""
+        with self.instrumentation.phase('render', **self.get_render_fields()) as phase:
+            print("Creating a mosaic...")
+            with open(path, 'wb') as file:
+                file.write(f"P6\n{self.width} {self.height}\n255\n".encode('ascii'))
+                for y, band in self.render_bands():
+                    file.write(band.tobytes())
+                    if writer:
+                        writer.write(band)
+                    self.progress_bar(y + len(band), self.height)
+            print()
+            phase.update(self.get_tile_cache_fields())
+
+    def write_pyramid(self, writer: DeepZoomWriter):
+        """Feed the rendered mosaic to a Deep Zoom writer, one band at a time"""
+        editedMatrix = np.asarray(self.editedImage)
+        for y in range(0, self.height, self.bandHeight):
+            writer.write(editedMatrix[y:y + self.bandHeight])
 
     def show_image(self):
         """Show image in default picture viewer"""
@@ -164,16 +825,74 @@ class PhotoMosaic:
         return math.sqrt(r + g + b)
 
     @staticmethod
-    def get_average(flatList: list) -> tuple:
-        """Return average RGB tuple from a list of given RGB values"""
-        r, g, b = 0, 0, 0
-        length = len(flatList)
-        for elem in flatList:
-            r += elem[0]
-            g += elem[1]
-            b += elem[2]
-        r, g, b = r / length, g / length, b / length
-        return r, g, b
+    def get_average(pixels) -> tuple:
+        """Return average RGB tuple from an array (or list) of given RGB(A) values"""
+        pixels = np.asarray(pixels)
+        pixels = pixels.reshape(-1, pixels.shape[-1])[:, :3]
+        r, g, b = pixels.mean(axis=0, dtype=np.float64)
+        return float(r), float(g), float(b)
+
+    @staticmethod
+    def get_cell_averages(matrix: np.ndarray, step: int) -> np.ndarray:
+        """Return a (rows, cols, 3) array with the average RGB value of every step x step cell.
+
+        Cells on the right and bottom edges may be smaller than step. Each row of cells is
+        summed down its columns without widening the whole matrix to float, np.add.reduceat
+        then sums every (possibly ragged) cell across and the sums are divided by the real
+        cell areas.
+        """
+        height, width = matrix.shape[:2]
+        rowStarts = np.arange(0, height, step)
+        colStarts = np.arange(0, width, step)
+        sums = np.empty((len(rowStarts), width, 3), dtype=np.float64)
+        for row, y in enumerate(rowStarts):
+            sums[row] = matrix[y:y + step, :, :3].sum(axis=0, dtype=np.uint32)
+        sums = np.add.reduceat(sums, colStarts, axis=1)
+        cellHeights = np.diff(np.append(rowStarts, height))
+        cellWidths = np.diff(np.append(colStarts, width))
+        return sums / (cellHeights[:, None, None] * cellWidths[None, :, None])
+
+    @staticmethod
+    def get_summed_area_table(matrix: np.ndarray, step: int) -> np.ndarray:
+        """Return a (rows + 1, cols + 1, 5) int64 summed-area table over the step x step blocks of a (height, width, 3) uint8 matrix.
+
+        Entry [r, c] sums the red, green and blue values, the squares of all three values and
+        the pixel count over every block above and to the left of block (r, c). Blocks on the
+        right and bottom edges may be smaller than step.
+        """
+        height, width = matrix.shape[:2]
+        rowStarts = np.arange(0, height, step)
+        colStarts = np.arange(0, width, step)
+        colWidths = np.diff(np.append(colStarts, width))
+        table = np.zeros((len(rowStarts) + 1, len(colStarts) + 1, 5), dtype=np.int64)
+        columns = np.empty((width, 4), dtype=np.int64)
+        for row, y in enumerate(rowStarts):
+            band = matrix[y:y + step, :, :3]
+            columns[:, :3] = band.sum(axis=0, dtype=np.uint32)
+            wide = band.astype(np.uint32)
+            columns[:, 3] = (wide * wide).sum(axis=(0, 2), dtype=np.uint64)
+            table[row + 1, 1:, :4] = np.add.reduceat(columns, colStarts, axis=0)
+            table[row + 1, 1:, 4] = len(band) * colWidths
+        return table.cumsum(axis=0).cumsum(axis=1)
+
+    @staticmethod
+    def get_cell_hashes(matrix: np.ndarray, step: int) -> np.ndarray:
+        """Return a (rows, cols) uint64 hash of the pixels of every step x step cell of a (height, width, 3) uint8 matrix.
+
+        Each hash is a sum of the cell's values times fixed random odd weights, wrapping around
+        at 64 bits, so any change to a cell changes its hash with near certainty.
+        """
+        height, width = matrix.shape[:2]
+        cols = math.ceil(width / step)
+        weights = np.random.default_rng(step).integers(0, 2 ** 63, (step, step * 3), dtype=np.uint64) * 2 + 1
+        hashes = np.empty((math.ceil(height / step), cols), dtype=np.uint64)
+        rowBlock = np.zeros((step, cols * step * 3), dtype=np.uint8)
+        for row, y in enumerate(range(0, height, step)):
+            block = matrix[y:y + step].reshape(-1, width * 3)
+            rowBlock[:len(block), :width * 3] = block
+            rowBlock[len(block):] = 0
+            hashes[row] = np.einsum('ycx,yx->c', rowBlock.reshape(step, cols, step * 3), weights, dtype=np.uint64)
+        return hashes
 
     @staticmethod
     def crop_center(pil_img: Image, crop_width: float, crop_height: float) -> Image:
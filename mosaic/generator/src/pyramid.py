@@ -0,0 +1,92 @@
+from PIL import Image
+import numpy as np
+import math, os
+
+
+class DeepZoomWriter:
+    """Write a Deep Zoom (DZI) tile pyramid of an image fed as horizontal bands, top to bottom.
+
+    Level maxLevel holds the image at full resolution and every level below it is half the
+    size of the one above, down to a single pixel at level 0. Each level keeps only the rows
+    it still needs for its next row of tiles, so the full image is never held in memory.
+    Tiles are written to <path>_files/<level>/<column>_<row>.<format> and the manifest to
+    <path>.dzi.
+    """
+
+    def __init__(self, path: str, width: int, height: int, tileSize: int = 254, overlap: int = 1,
+                 format: str = 'jpg', quality: int = 90):
+        self.path = path
+        self.width, self.height = width, height
+        self.tileSize, self.overlap = tileSize, overlap
+        self.format, self.quality = format, quality
+        self.maxLevel = math.ceil(math.log2(max(width, height)))
+        self.levels = []
+        for level in range(self.maxLevel, -1, -1):
+            scale = 2 ** (self.maxLevel - level)
+            self.levels.append({'level': level, 'width': math.ceil(width / scale), 'height': math.ceil(height / scale),
+                                'buffer': np.empty((0, math.ceil(width / scale), 3), dtype=np.uint8),
+                                'top': 0, 'received': 0, 'tileRow': 0, 'carry': None})
+            os.makedirs(os.path.join(f"{path}_files", str(level)), exist_ok=True)
+
+    def write(self, band: np.ndarray):
+        """Add the next rows of the full resolution image"""
+        self.feed(0, band)
+
+    def close(self):
+        """Flush the remaining rows of every level and write the manifest"""
+        for depth, state in enumerate(self.levels):
+            if state['carry'] is not None and depth + 1 < len(self.levels):
+                self.feed(depth + 1, self.downsample(state['carry']))
+                state['carry'] = None
+        with open(f"{self.path}.dzi", 'w') as manifest:
+            manifest.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                           f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{self.tileSize}" '
+                           f'Overlap="{self.overlap}" Format="{self.format}">\n'
+                           f'  <Size Width="{self.width}" Height="{self.height}"/>\n'
+                           '</Image>\n')
+
+    def feed(self, depth: int, rows: np.ndarray):
+        """Append rows to a level, write every row of tiles they complete and pass them down a level"""
+        state = self.levels[depth]
+        state['buffer'] = np.concatenate((state['buffer'], rows))
+        state['received'] += len(rows)
+        while state['tileRow'] * self.tileSize < state['height']:
+            y = state['tileRow'] * self.tileSize
+            y2 = min(state['height'], y + self.tileSize + self.overlap)
+            if state['received'] < y2:
+                break
+            self.write_tile_row(state, max(0, y - self.overlap), y2)
+            state['tileRow'] += 1
+            # Keep the rows the next row of tiles overlaps with
+            keepFrom = state['tileRow'] * self.tileSize - self.overlap
+            if keepFrom > state['top']:
+                state['buffer'] = state['buffer'][keepFrom - state['top']:]
+                state['top'] = keepFrom
+
+        if depth + 1 < len(self.levels):
+            if state['carry'] is not None:
+                rows = np.concatenate((state['carry'], rows))
+            pairs = len(rows) - len(rows) % 2
+            state['carry'] = rows[pairs:] if pairs < len(rows) else None
+            if state['received'] == state['height'] and state['carry'] is not None:
+                pairs, state['carry'] = len(rows), None
+            if pairs:
+                self.feed(depth + 1, self.downsample(rows[:pairs]))
+
+    def write_tile_row(self, state: dict, y: int, y2: int):
+        """Write all tiles of a level whose rows span y to y2"""
+        rows = state['buffer'][y - state['top']:y2 - state['top']]
+        for column, x in enumerate(range(0, state['width'], self.tileSize)):
+            x1, x2 = max(0, x - self.overlap), min(state['width'], x + self.tileSize + self.overlap)
+            tilePath = os.path.join(f"{self.path}_files", str(state['level']),
+                                    f"{column}_{state['tileRow']}.{self.format}")
+            Image.fromarray(np.ascontiguousarray(rows[:, x1:x2])).save(tilePath, quality=self.quality)
+
+    @staticmethod
+    def downsample(rows: np.ndarray) -> np.ndarray:
+        """Return rows halved in both directions by averaging 2 x 2 blocks (or the partial blocks at odd edges)"""
+        height, width = rows.shape[:2]
+        rowStarts, colStarts = np.arange(0, height, 2), np.arange(0, width, 2)
+        sums = np.add.reduceat(np.add.reduceat(rows, rowStarts, axis=0, dtype=np.uint32), colStarts, axis=1)
+        counts = np.diff(np.append(rowStarts, height))[:, None, None] * np.diff(np.append(colStarts, width))[None, :, None]
+        return ((sums + counts // 2) // counts).astype(np.uint8)
@@ -0,0 +1,47 @@
+import numpy as np
+import os, zipfile
+
+
+class RenderCache:
+    """The last mosaic rendered from a target, kept in cacheDir so a re-render only redoes changed cells.
+
+    The state is a .npz of the hash of every cell of the target, the tile chosen for it and
+    the seed the choices were drawn with, next to a .npy of the mosaic's pixels. Both are
+    named after a key that identifies the target's name, size, step and tile library.
+    """
+
+    def __init__(self, cacheDir: str, key: str):
+        self.statePath = os.path.join(cacheDir, f'render-{key}.npz')
+        self.mosaicPath = os.path.join(cacheDir, f'render-{key}.npy')
+
+    def load(self) -> tuple:
+        """Return (hashes, tiles, seed, mosaic) of the previous render, with mosaic memory-mapped, or None"""
+        try:
+            with np.load(self.statePath) as data:
+                hashes, tiles, seed = data['hashes'], data['tiles'], int(data['seed'])
+            mosaic = np.load(self.mosaicPath, mmap_mode='r')
+        except (FileNotFoundError, KeyError, ValueError, zipfile.BadZipFile):
+            return None
+        return hashes, tiles, seed, mosaic
+
+    def save(self, hashes: np.ndarray, tiles: np.ndarray, seed: int, mosaic: np.ndarray, rows: list = None):
+        """Replace the saved render; the state is removed first and written last, so it never describes other pixels.
+
+        When rows of pixels (as (y, y2) ranges) are given, only those are written into the saved mosaic.
+        """
+        os.makedirs(os.path.dirname(self.statePath) or '.', exist_ok=True)
+        try:
+            os.remove(self.statePath)
+        except FileNotFoundError:
+            pass
+        if rows is not None and os.path.exists(self.mosaicPath):
+            saved = np.load(self.mosaicPath, mmap_mode='r+')
+            for y, y2 in rows:
+                saved[y:y2] = mosaic[y:y2]
+            saved.flush()
+            del saved
+        else:
+            np.save(self.mosaicPath + '.tmp.npy', mosaic)
+            os.replace(self.mosaicPath + '.tmp.npy', self.mosaicPath)
+        np.savez(self.statePath + '.tmp.npz', hashes=hashes, tiles=tiles, seed=np.array(str(seed)))
+        os.replace(self.statePath + '.tmp.npz', self.statePath)
@@ -1,18 +1,152 @@
 from photomosaics import PhotoMosaic
-import argparse
+from instrumentation import Instrumentation, JsonLinesSink
+from outputs import OUTPUT_FORMATS, OutputEncoder
+import argparse, contextlib, cProfile, os, pstats, tracemalloc
+
+CIFAR_DATASETS = ('cifar10', 'cifar100', 'cifar100superclass')
+
+
+def get_tile_source(imagesFolder: str):
+    """Return imagesFolder, or the images it names as an array.
+
+    Arrays are named as source[:label,label...], where source is a CIFAR dataset read from its
+    tarball or a .npy file exported by `cifar.py --format npy`.
+    """
+    source, _, labels = imagesFolder.partition(':')
+    labels = labels.split(',') if labels else None
+    if source.endswith('.npy'):
+        from cifar import load_exported_tiles
+        return load_exported_tiles(source, labels)
+    if os.path.isdir(imagesFolder) or source not in CIFAR_DATASETS:
+        return imagesFolder
+    from cifar import load_cifar_tiles
+    return load_cifar_tiles(source, labels)
+
+
+def add_options(parser: argparse.ArgumentParser):
+    """Add the matching, caching, rendering and output options shared with batch.py"""
+    parser.add_argument('--match', type=str,
+                        help='nearest tile search: KD-tree index, brute-force reference scan or quantized RGB lookup table',
+                        nargs=1, default=['kdtree'], choices=['kdtree', 'brute', 'lut'])
+    parser.add_argument('--lutSize', type=int, help='cells per channel of the RGB lookup table used by --match lut',
+                        nargs=1, default=[64])
+    parser.add_argument('--lutError', action='store_true',
+                        help='report how --match lut compares with exact matching on this image')
+    parser.add_argument('--cacheDir', type=str, help='folder for the tile feature cache',
+                        nargs=1, default=['cache'])
+    parser.add_argument('--hashTiles', action='store_true',
+                        help='validate cached tiles by a hash of their contents, not just size and mtime')
+    parser.add_argument('--tileCache', type=int,
+                        help='decode tile pixels only once chosen, keeping at most this many decoded tiles per process, '
+                             'so memory grows with the tiles used rather than the library', nargs=1, default=[None])
+    parser.add_argument('--renderCache', action='store_true',
+                        help='keep every render in the cache folder, so re-rendering a touched-up target with the same '
+                             'settings only redoes the cells that changed')
+    parser.add_argument('--minStep', type=int,
+                        help='split cells of --step into quarters, down to this size (step divided by a power of two), '
+                             'wherever their colours vary more than --splitDeviation', nargs=1, default=[None])
+    parser.add_argument('--splitDeviation', type=float,
+                        help='RMS distance of pixels from their average colour above which --minStep splits a cell',
+                        nargs=1, default=[24.0])
+    parser.add_argument('--workers', type=int, help='number of worker processes for loading tiles and rendering',
+                        nargs=1, default=[1])
+    parser.add_argument('--seed', type=int, help='random seed for choosing among equally matching tiles',
+                        nargs=1, default=[None])
+    parser.add_argument('--stream', action='store_true',
+                        help='render band by band straight into a PPM file, without holding the whole mosaic in memory')
+    parser.add_argument('--bandHeight', type=int, help='height in pixels of the bands rendered at a time',
+                        nargs=1, default=[1024])
+    parser.add_argument('--pyramid', action='store_true',
+                        help='also save a Deep Zoom (DZI) tile pyramid of the mosaic for tiled zooming')
+    parser.add_argument('--tileSize', type=int, help='width and height of the Deep Zoom pyramid tiles',
+                        nargs=1, default=[254])
+    parser.add_argument('--outputs', type=str,
+                        help='files to encode in parallel: the full-size mosaic in the format of the target, WebP and '
+                             'progressive JPEG previews of --previewWidth, and a thumbnail of --thumbWidth',
+                        nargs='+', default=['full'], choices=['full', *OUTPUT_FORMATS])
+    parser.add_argument('--previewWidth', type=int, help='largest width of the webp and jpeg previews',
+                        nargs=1, default=[2048])
+    parser.add_argument('--thumbWidth', type=int, help='largest width of the thumbnail', nargs=1, default=[400])
+    parser.add_argument('--compressLevel', type=int, choices=range(10), metavar='{0..9}',
+                        help='zlib level of full-size PNG mosaics, trading file size for encode time',
+                        nargs=1, default=[3])
+    parser.add_argument('--events', type=str,
+                        help='append a JSON line for the start and end of every phase (durations, counts, cache hits, '
+                             'memory) to this file', nargs=1, default=[None])
+    parser.add_argument('--profile', type=str, help='profile the run with cProfile and save the stats to this file',
+                        nargs=1, default=[None])
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='trace Python allocations, adding peak traced memory to every phase event and '
+                             'printing the largest allocation sites at the end')
+
+
+def check_options(parser: argparse.ArgumentParser, args):
+    """Exit with a usage error on combinations of the add_options options that can't be rendered"""
+    if args.stream and 'full' not in args.outputs:
+        parser.error("--stream only writes the full-size mosaic, so --outputs must include full")
+
+
+def get_mosaic_options(args, instrumentation: Instrumentation) -> dict:
+    """Return the PhotoMosaic keyword arguments set by the add_options options"""
+    return {'matchMode': args.match[0], 'cacheDir': args.cacheDir[0], 'hashTiles': args.hashTiles,
+            'workers': args.workers[0], 'seed': args.seed[0], 'stream': args.stream, 'bandHeight': args.bandHeight[0],
+            'lutSize': args.lutSize[0], 'instrumentation': instrumentation, 'tileCacheSize': args.tileCache[0],
+            'renderCache': args.renderCache, 'minStep': args.minStep[0], 'splitDeviation': args.splitDeviation[0]}
+
+
+def get_encoder(args) -> OutputEncoder:
+    """Return the OutputEncoder set up by the --outputs, --previewWidth, --thumbWidth and --compressLevel options"""
+    return OutputEncoder(args.outputs, args.previewWidth[0], args.thumbWidth[0], args.compressLevel[0])
+
+
+@contextlib.contextmanager
+def instrumented(args):
+    """Yield the Instrumentation set up by the --events, --profile and --tracemalloc options, for the enclosed run"""
+    instrumentation = Instrumentation([JsonLinesSink(args.events[0])] if args.events[0] else [])
+    profiler = cProfile.Profile() if args.profile[0] else None
+    if args.tracemalloc:
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+    try:
+        yield instrumentation
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile[0])
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+            print(f"Profile has been saved to {args.profile[0]}.")
+        if args.tracemalloc:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            print("Largest allocation sites still held:")
+            for statistic in snapshot.statistics('lineno')[:10]:
+                print(f"  {statistic}")
+        instrumentation.close()
 
 
 def main():
     parser = argparse.ArgumentParser(description='Convert an image to a photo mosaic.')
     parser.add_argument('imagePath', type=str, help='path to image file that will be converted')
-    parser.add_argument('imagesFolder', type=str, help='path to folder with images that will be used for photo mosaic')
+    parser.add_argument('imagesFolder', type=str,
+                        help='path to folder with images that will be used for photo mosaic, or a CIFAR dataset '
+                             'or exported .npy file to read tiles from as source[:label,label...], e.g. cifar10:dog')
     parser.add_argument('--baseWidth', type=int, help='target width for photo mosaic',
                         nargs=1, default=[5000])
     parser.add_argument('--step', type=int, help='height and width of sub-image in photo mosaic',
                         nargs=1, default=[100])
+    add_options(parser)
     args = parser.parse_args()
+    check_options(parser, args)
 
-    PhotoMosaic(args.imagePath, args.imagesFolder, args.step[0], args.baseWidth[0]).save_image()
+    with instrumented(args) as instrumentation:
+        mosaic = PhotoMosaic(args.imagePath, get_tile_source(args.imagesFolder), args.step[0],
+                             targetWidth=args.baseWidth[0], **get_mosaic_options(args, instrumentation))
+        if args.lutError and mosaic.lut is not None:
+            error = mosaic.lut_error()
+            print(f"Lookup table matched {error['mismatched']:.2%} of {error['cells']} cells to a different tile, "
+                  f"{error['meanExtraDistance']:.3f} further on average (at most {error['maxExtraDistance']:.3f}).")
+        mosaic.save_image(args.pyramid, args.tileSize[0], encoder=get_encoder(args))
 
 
 if __name__ == '__main__':
@@ -9,8 +9,7 @@
 from selenium.common.exceptions import StaleElementReferenceException
 from selenium.webdriver.common.keys import Keys
 from selenium import webdriver
-import urllib.request
-import os
+from downloader import Downloader
 
 
 def create_driver(driverPath):
@@ -39,25 +38,26 @@ def scrapeImageURLs(driver, pages):
     return totalImages
 
 
-def downloadImages(srcList, arg):
-    """Download images provided in srcList and save them to folder"""
+def downloadImages(srcList, arg, connections=8, thumbnail=None):
+    """Download images provided in srcList and save them to folder, concurrently and skipping duplicates.
+
+    With thumbnail set to a (width, height) tile size, images are cropped and thumbnailed as they arrive.
+    """
     print(f"Downloading {arg} images...")
-    previous_path = os.getcwd()
     folder = f'{arg.capitalize()} Images'
-    if not os.path.exists(folder):
-        os.mkdir(folder)
-    os.chdir(folder)
-    amtOfImages = len(srcList)
-    counter = 0
-    for index, src in enumerate(srcList):
-        imageName = f'{arg}-{counter}.jpg'
-        if os.path.exists(imageName):
-            while os.path.exists(imageName):
-                counter += 1
-                imageName = f'{arg}-{counter}.jpg'
-        urllib.request.urlretrieve(src, imageName)
-        print(f"Downloaded {index + 1}/{amtOfImages} images.")
-    os.chdir(previous_path)
+    downloader = Downloader(folder, arg, connections=connections, thumbnail=thumbnail)
+
+    def progress(done, total, result):
+        url, status, detail = result
+        if status == 'failed':
+            print(f"Failed to download {url}: {detail}")
+        print(f"Downloaded {done}/{total} images.")
+
+    results = downloader.download(srcList, progress)
+    saved = sum(status == 'saved' for _, status, _ in results)
+    duplicates = sum(status == 'duplicate' for _, status, _ in results)
+    print(f"Saved {saved} images to {folder}, skipped {duplicates} duplicates.")
+    return results
 
 
 def main():
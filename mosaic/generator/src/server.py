@@ -0,0 +1,276 @@
+from photomosaics import PhotoMosaic
+from outputs import OutputEncoder
+from tilecache import TileCache
+from run import add_options, check_options, get_encoder, get_mosaic_options, get_tile_source, instrumented
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict, deque
+import numpy as np
+import argparse, copy, json, os, queue, signal, socketserver, threading, time, uuid
+
+
+class RenderService:
+    """Render mosaics for local clients, with the tile libraries kept loaded between requests.
+
+    A library (tiles, match index and lookup table) is loaded once per step and shared by a pool
+    of worker threads, each rendering on a shallow copy of it, so a request only pays for loading
+    its target, rendering and saving. Jobs wait in a queue of at most queueSize; submitting to a
+    full queue fails rather than letting waiting time grow without bound. Queue wait, render
+    and save times of recent jobs are kept for get_metrics.
+    """
+
+    def __init__(self, imagesFolder: str, steps: list, options: dict, encoder: OutputEncoder, outFolder: str = 'out',
+                 pyramid: bool = False, tileSize: int = 254, workers: int = 2, queueSize: int = 16,
+                 history: int = 1000):
+        # options are the PhotoMosaic keyword arguments of every library
+        self.tileSource = get_tile_source(imagesFolder)
+        self.options, self.encoder, self.outFolder = options, encoder, outFolder
+        self.pyramid, self.tileSize = pyramid, tileSize
+        self.queue = queue.Queue(queueSize)
+        self.lock = threading.Lock()
+        self.libraries, self.libraryLocks = {}, {}
+        self.jobs = OrderedDict()
+        self.history = history
+        self.latencies = deque(maxlen=history)
+        self.running = self.completed = self.failed = self.rejected = 0
+        self.started = time.time()
+        self.defaultStep = steps[0]
+        for step in steps:
+            self.get_library(step)
+        self.workers = [threading.Thread(target=self.work, name=f'render-{n}', daemon=True) for n in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def get_library(self, step: int) -> PhotoMosaic:
+        """Return the PhotoMosaic holding the library at step, loading it the first time it is asked for"""
+        with self.lock:
+            lock = self.libraryLocks.setdefault(step, threading.Lock())
+        with lock:
+            if step not in self.libraries:
+                start = time.time()
+                self.libraries[step] = PhotoMosaic(None, self.tileSource, step, **self.options)
+                print(f"Loaded {len(self.libraries[step].tiles)} tiles at step {step} in {time.time() - start:.2f} s.")
+            return self.libraries[step]
+
+    def submit(self, request: dict) -> dict:
+        """Queue a render job and return it, or raise queue.Full when the queue is full.
+
+        request holds the target 'image' path, and optionally positive integers 'baseWidth' and 'step' and a
+        non-negative integer 'seed'; anything else raises ValueError.
+        """
+        if not isinstance(request.get('image'), str) or not os.path.isfile(request['image']):
+            raise ValueError(f"image {request.get('image')!r} is not a file")
+        for key in ('baseWidth', 'step'):
+            if key in request and (type(request[key]) is not int or request[key] <= 0):
+                raise ValueError(f"{key} must be a positive integer")
+        if request.get('seed') is not None and (type(request['seed']) is not int or request['seed'] < 0):
+            raise ValueError("seed must be a non-negative integer")
+        job = {'id': uuid.uuid4().hex[:12], 'status': 'queued', 'request': request, 'submitted': time.time(),
+               'done': threading.Event()}
+        with self.lock:
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                self.rejected += 1
+                raise
+            self.jobs[job['id']] = job
+            # Forget the oldest finished jobs
+            while len(self.jobs) > self.history and next(iter(self.jobs.values()))['done'].is_set():
+                self.jobs.popitem(last=False)
+        return job
+
+    def work(self):
+        """Render queued jobs until a None job arrives"""
+        mosaics = {}
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            with self.lock:
+                self.running += 1
+                job.update(status='running', wait=time.time() - job['submitted'])
+            try:
+                request = job['request']
+                step = request.get('step', self.defaultStep)
+                if step not in mosaics:
+                    # Tiles, index and lookup table are shared, but not the LRU of tiles decoded on demand:
+                    # copying a TileCache gives an empty one
+                    library = self.get_library(step)
+                    mosaics[step] = copy.copy(library)
+                    if isinstance(library.tiles, TileCache):
+                        mosaics[step].tiles = copy.copy(library.tiles)
+                result = dict(self.render(mosaics[step], request, os.path.join(self.outFolder, job['id'])),
+                              status='done')
+            except Exception as error:
+                result = {'status': 'failed', 'error': f"{type(error).__name__}: {error}"}
+            with self.lock:
+                job.update(result, total=time.time() - job['submitted'])
+                self.running -= 1
+                if job['status'] == 'done':
+                    self.completed += 1
+                    self.latencies.append((job['wait'], job['render'], job['save'], job['total']))
+                else:
+                    self.failed += 1
+            job['done'].set()
+
+    def render(self, mosaic: PhotoMosaic, request: dict, folderName: str) -> dict:
+        """Render and save one request on a worker's mosaic, returning the paths and timings of the job"""
+        start = time.time()
+        seed = request.get('seed', self.options['seed'])
+        mosaic.seed = seed if seed is not None else np.random.SeedSequence().entropy
+        mosaic.fixedSeed = seed is not None
+        mosaic.set_target(request['image'], request.get('baseWidth', self.options['targetWidth']))
+        if not mosaic.stream:
+            mosaic.editedImage = mosaic.photo_mosaic()
+        rendered = time.time()
+        mosaic.save_image(self.pyramid, self.tileSize, folderName, self.encoder)
+        return {'render': rendered - start, 'save': time.time() - rendered, 'paths': mosaic.outputPaths,
+                'width': mosaic.width, 'height': mosaic.height}
+
+    def describe(self, job: dict) -> dict:
+        """Return the JSON-serializable status, timings and output paths of a job"""
+        with self.lock:
+            return {key: value for key, value in job.items() if key != 'done'}
+
+    def get_job(self, jobId: str) -> dict:
+        """Return a job by id, or None"""
+        with self.lock:
+            return self.jobs.get(jobId)
+
+    def get_metrics(self) -> dict:
+        """Return queue depth, job counts and latency percentiles of recent jobs"""
+        with self.lock:
+            latencies = list(self.latencies)
+            metrics = {'queueDepth': self.queue.qsize(), 'queueSize': self.queue.maxsize, 'running': self.running,
+                       'workers': len(self.workers), 'completed': self.completed, 'failed': self.failed,
+                       'rejected': self.rejected, 'steps': sorted(self.libraries), 'uptime': time.time() - self.started}
+        for position, name in enumerate(('wait', 'render', 'save', 'total')):
+            values = sorted(latency[position] for latency in latencies)
+            metrics[name] = {'count': len(values)}
+            if values:
+                metrics[name].update(mean=sum(values) / len(values), p50=values[len(values) // 2],
+                                     p95=values[min(len(values) - 1, int(len(values) * 0.95))], max=values[-1])
+        return metrics
+
+    def close(self):
+        """Let the workers finish the queued jobs and stop"""
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """HTTP interface of a RenderService:
+
+    POST /render      queue a job from a JSON body, 202 with the job (200 once done with ?wait=1),
+                      503 when the queue is full
+    GET /jobs/<id>    a job's status, timings and output paths
+    GET /metrics      queue depth, job counts and latencies
+    """
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/metrics':
+            self.send_json(200, service.get_metrics())
+        elif self.path.startswith('/jobs/'):
+            job = service.get_job(self.path[len('/jobs/'):])
+            if job:
+                self.send_json(200, service.describe(job))
+            else:
+                self.send_json(404, {'error': 'no such job'})
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        path, _, query = self.path.partition('?')
+        if path != '/render':
+            return self.send_json(404, {'error': 'not found'})
+        service = self.server.service
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not isinstance(request, dict):
+                raise ValueError("expected a JSON object")
+            job = service.submit(request)
+        except queue.Full:
+            return self.send_json(503, {'error': 'render queue is full'})
+        except ValueError as error:
+            return self.send_json(400, {'error': str(error)})
+        if 'wait=1' in query.split('&'):
+            job['done'].wait()
+            return self.send_json(200 if job['status'] == 'done' else 500, service.describe(job))
+        self.send_json(202, service.describe(job))
+
+    def send_json(self, status: int, body: dict):
+        data = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server listening on a Unix domain socket"""
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve photo mosaic renders from tile libraries kept in memory.')
+    parser.add_argument('imagesFolder', type=str,
+                        help='path to folder with images that will be used for photo mosaics, or a CIFAR dataset '
+                             'or exported .npy file to read tiles from as source[:label,label...], e.g. cifar10:dog')
+    parser.add_argument('--baseWidth', type=int, help='target width of requests that don\'t give one',
+                        nargs=1, default=[5000])
+    parser.add_argument('--step', type=int, help='steps to load libraries for at startup; the first is the default '
+                                                 'and other steps are loaded when first requested',
+                        nargs='+', default=[100])
+    parser.add_argument('--outFolder', type=str, help='folder to save the photo mosaics to, in a subfolder per job',
+                        nargs=1, default=['out'])
+    parser.add_argument('--host', type=str, help='address to listen on', nargs=1, default=['127.0.0.1'])
+    parser.add_argument('--port', type=int, help='port to listen on', nargs=1, default=[8765])
+    parser.add_argument('--socket', type=str, help='listen on this Unix socket instead of --host and --port',
+                        nargs=1, default=[None])
+    parser.add_argument('--renderThreads', type=int, help='number of jobs rendered at the same time',
+                        nargs=1, default=[2])
+    parser.add_argument('--queueSize', type=int, help='number of jobs that may wait, beyond which requests are refused',
+                        nargs=1, default=[16])
+    add_options(parser)
+    args = parser.parse_args()
+    check_options(parser, args)
+
+    with instrumented(args) as instrumentation:
+        options = dict(get_mosaic_options(args, instrumentation), targetWidth=args.baseWidth[0])
+        service = RenderService(args.imagesFolder, args.step, options, get_encoder(args), args.outFolder[0],
+                                args.pyramid, args.tileSize[0], args.renderThreads[0], args.queueSize[0])
+        if args.socket[0]:
+            if os.path.exists(args.socket[0]):
+                os.remove(args.socket[0])
+            server = UnixHTTPServer(args.socket[0], RenderRequestHandler)
+            print(f"Listening on {args.socket[0]}.")
+        else:
+            server = ThreadingHTTPServer((args.host[0], args.port[0]), RenderRequestHandler)
+            print(f"Listening on http://{args.host[0]}:{server.server_port}.")
+        server.service = service
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            print("Finishing queued jobs...")
+            service.close()
+            if args.socket[0]:
+                os.remove(args.socket[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class SharedArray:
+    """A NumPy array backed by a named shared memory block.
+
+    The creating process owns the block and must unlink() it; worker processes attach to it
+    with SharedArray.attach(spec) and read or write the same memory without any pickling.
+    """
+
+    def __init__(self, shape: tuple, dtype, name: str = None):
+        self.shape, self.dtype = tuple(shape), np.dtype(dtype)
+        size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+        self.memory = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.array = np.ndarray(self.shape, self.dtype, buffer=self.memory.buf)
+
+    @classmethod
+    def from_array(cls, array: np.ndarray) -> 'SharedArray':
+        """Return a new shared array holding a copy of array"""
+        shared = cls(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, spec: tuple) -> 'SharedArray':
+        """Attach to an existing shared array from its spec"""
+        name, shape, dtype = spec
+        return cls(shape, dtype, name=name)
+
+    @property
+    def spec(self) -> tuple:
+        """Return the picklable (name, shape, dtype) needed to attach from another process"""
+        return self.memory.name, self.shape, self.dtype.str
+
+    def close(self):
+        """Release this process' view of the shared memory"""
+        self.array = None
+        self.memory.close()
+
+    def unlink(self):
+        """Release and destroy the shared memory, called once by its owner"""
+        self.close()
+        self.memory.unlink()
@@ -0,0 +1,49 @@
+from collections import OrderedDict
+import numpy as np
+
+
+class TileCache:
+    """Tile pixels of an image library, decoded on demand and kept in a bounded LRU cache.
+
+    Behaves like the (tiles, height, width, 3) uint8 array of an eagerly loaded library for
+    len() and indexing with an int or an array of indices, but only holds the maxTiles most
+    recently used tiles. loader(path, dimension) returns (tile, average) of an image file.
+    """
+
+    def __init__(self, paths: list, dimension: tuple, loader, maxTiles: int = 4096):
+        self.paths, self.dimension, self.loader = list(paths), tuple(dimension), loader
+        self.maxTiles = max(1, maxTiles)
+        self.tiles = OrderedDict()
+        self.hits = self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        if np.ndim(index) == 0:
+            return self.get(int(index))
+        indices = np.asarray(index).ravel()
+        stacked = np.empty((len(indices), self.dimension[1], self.dimension[0], 3), dtype=np.uint8)
+        for position, tile in enumerate(indices.tolist()):
+            stacked[position] = self.get(tile)
+        return stacked.reshape(np.shape(index) + stacked.shape[1:])
+
+    def get(self, index: int) -> np.ndarray:
+        """Return one tile, decoding it if it isn't cached and evicting the least recently used one if full"""
+        tile = self.tiles.get(index)
+        if tile is not None:
+            self.tiles.move_to_end(index)
+            self.hits += 1
+            return tile
+        self.misses += 1
+        tile, _ = self.loader(self.paths[index], self.dimension)
+        self.tiles[index] = tile
+        if len(self.tiles) > self.maxTiles:
+            self.tiles.popitem(last=False)
+        return tile
+
+    def __getstate__(self) -> dict:
+        # Worker processes get the paths but start with an empty cache of their own
+        state = self.__dict__.copy()
+        state['tiles'], state['hits'], state['misses'] = OrderedDict(), 0, 0
+        return state